@@ -0,0 +1,131 @@
+"""
+    benchSampleLog
+    Round-trip and size benchmark for the flash sample logs: sensors.SampleLog (12 byte
+    records) against sensors.CompressedSampleLog, on synthetic series shaped like what
+    the ENS160AHT21 logs, or on the columns of a CSV like webdocs/data.csv.
+
+    python _testing/benchSampleLog.py [--days 7] [--interval 30] [--scale 100] [--flash 524288]
+    python _testing/benchSampleLog.py --csv uploadToEsp/webdocs/data.csv
+
+    Each series is written through both logs into a temporary directory, read back with
+    query() and compared (the compressed log to within 1/scale). Reported per format:
+    bytes on flash, bytes per value, the ratio to the raw log, write and read time per
+    sample, and how many days of samples --flash bytes would hold.
+"""
+import sys
+import os
+import time
+import random
+import shutil
+import tempfile
+import argparse
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UPLOAD = os.path.join(REPO, "uploadToEsp")
+sys.path[:0] = [UPLOAD, os.path.join(UPLOAD, "lib"), os.path.dirname(os.path.abspath(__file__))]
+from benchWebServer import hostStandIns
+
+def walk(value, step, low, high, digits):
+    # Slowly wandering reading, rounded as the sensor driver rounds it
+    value = min(high, max(low, value + random.uniform(-step, step)))
+    return value, round(value, digits) if digits else int(value)
+
+def synthetic(days, interval):
+    # ENS160AHT21-shaped samples: time, then a dict as Sensor.values has it
+    t = 790000000
+    temp, rh, co2, tvoc = 21.0, 50.0, 450.0, 100.0
+    for i in range(int(days * 86400 / interval)):
+        temp, tempR = walk(temp, 0.05, 15, 30, 1)
+        rh, rhR = walk(rh, 0.2, 30, 70, 1)
+        co2, co2R = walk(co2, 5, 400, 2000, 0)
+        tvoc, tvocR = walk(tvoc, 3, 0, 1000, 0)
+        yield t + i * interval + random.choice((0, 0, 0, 1)), {
+            "AHT_Temp": tempR, "AHT_RH": rhR, "CO2": co2R, "TVOC": tvocR,
+            "AQI": 1 + co2R // 400, "Validity": 0, "ENS_Temp": round(tempR - 0.3, 1),
+            "ENS_RH": round(rhR + 1.2, 1), "ECO2_Rating": "Good"}
+
+def fromCsv(path):
+    # Every numeric column after Line, Date and Time, one sample a row, 30 secs apart
+    with open(path) as f:
+        names = [n.strip() for n in f.readline().split(",")]
+        t = 790000000
+        for line in f:
+            fields = line.strip().split(",")
+            if len(fields) != len(names):
+                continue
+            values = {}
+            for name, field in zip(names[3:], fields[3:]):
+                try:
+                    values[name] = float(field)
+                except ValueError:
+                    pass
+            yield t, values
+            t += 30
+
+def run(logClass, samples, tolerance, **kwargs):
+    import asyncio
+    path = tempfile.mkdtemp(prefix="samplelog")
+    result = {}
+
+    async def main():
+        log = logClass(path, maxSegments=100000, flushInterval=0, **kwargs)
+        start = time.perf_counter()
+        for t, values in samples:
+            log.add(t, values)
+        log.flush()
+        result["write"] = time.perf_counter() - start
+        start = time.perf_counter()
+        got = list(log.query())
+        result["read"] = time.perf_counter() - start
+        result["bytes"] = sum(os.path.getsize(os.path.join(path, n)) for n in os.listdir(path)
+                              if n.endswith(logClass.SUFFIX))
+        expected = [(t, k, v) for t, values in samples for k, v in values.items() if isinstance(v, (int, float))]
+        result["values"] = len(expected)
+        bad = len(got) != len(expected)
+        for a, b in zip(got, expected):
+            if a[0] != b[0] or a[1] != b[1] or abs(a[2] - b[2]) > tolerance:
+                bad = True
+                break
+        result["ok"] = not bad
+    try:
+        asyncio.run(main())
+    finally:
+        shutil.rmtree(path)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="SampleLog size and round-trip benchmark")
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--interval", type=int, default=30, help="secs between samples")
+    parser.add_argument("--scale", type=int, default=100, help="CompressedSampleLog quantisation")
+    parser.add_argument("--flash", type=int, default=512 * 1024, help="bytes of flash for the log")
+    parser.add_argument("--csv", help="take the series from a CSV like webdocs/data.csv instead")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if sys.implementation.name != "micropython":
+        hostStandIns()
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    from sensors.SampleLog import SampleLog, RECORD
+    from sensors.CompressedSampleLog import CompressedSampleLog
+
+    random.seed(args.seed)
+    samples = list(fromCsv(args.csv) if args.csv else synthetic(args.days, args.interval))
+    span = (samples[-1][0] - samples[0][0] + args.interval) / 86400
+    print("%d samples over %.1f days%s" % (len(samples), span, " from " + args.csv if args.csv else ""))
+    # float32 on the way through the raw log
+    raw = run(SampleLog, samples, 1e-3 * max(1, max(abs(v) for t, s in samples for v in s.values()
+                                                   if isinstance(v, (int, float)))))
+    compressed = run(CompressedSampleLog, samples, 0.5 / args.scale + 1e-9, scale=args.scale)
+    print("%-20s %10s %8s %7s %9s %9s %8s %5s" % ("format", "bytes", "B/value", "ratio",
+                                                   "write us", "read us", "days", "ok"))
+    for name, r in (("SampleLog", raw), ("CompressedSampleLog", compressed)):
+        print("%-20s %10d %8.2f %7.2f %9.1f %9.1f %8.1f %5s" % (
+            name, r["bytes"], r["bytes"] / r["values"], raw["bytes"] / r["bytes"],
+            r["write"] / len(samples) * 1e6, r["read"] / len(samples) * 1e6,
+            span * args.flash / r["bytes"], r["ok"]))
+    print("(raw record: %d bytes a value)" % RECORD)
+    return 0 if raw["ok"] and compressed["ok"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+# Micro-benchmark: web.url_decode against the three decoders it replaced
+# (copied here as they were). Runs on the ESP32 (copy to / and run from the REPL with
+# uploadToEsp's web package on the board) or on a computer from the repo root:
+#     python _testing/benchUrlDecode.py
+import sys
+import re
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    from time import perf_counter
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+    def ticks_diff(a, b):
+        return a - b
+if sys.implementation.name != "micropython":
+    sys.path.append("uploadToEsp")
+from web.url_decode import url_decode, _decode, _decode_py
+
+# web/url_parse.py
+def url_parse(url):
+    url = url.replace('+',' ')
+    l = len(url)
+    data = bytearray()
+    i = 0
+    while i < l:
+        if url[i] != '%':
+            d = ord(url[i])
+            i += 1
+        else:
+            d = int(url[i+1:i+3], 16)
+            i += 3
+        data.append(d)
+    return data.decode('utf8')
+
+# web/unquote.py
+_hextobyte_cache = None
+def unquote(string):
+    global _hextobyte_cache
+    if not string:
+        return b''
+    if isinstance(string, str):
+        string = string.encode('utf-8')
+    bits = string.split(b'%')
+    if len(bits) == 1:
+        return string
+    res = [bits[0]]
+    append = res.append
+    if _hextobyte_cache is None:
+        _hextobyte_cache = {}
+    for item in bits[1:]:
+        try:
+            code = item[:2]
+            char = _hextobyte_cache.get(code)
+            if char is None:
+                char = _hextobyte_cache[code] = bytes([int(code, 16)])
+            append(char)
+            append(item[2:])
+        except KeyError:
+            append(b'%')
+            append(item)
+    return b''.join(res).decode("utf-8").replace('+',' ')
+
+# RequestParser.unquote - only ever handled %20 and %0A
+def parser_unquote(url_string):
+    url_string = re.sub(r'%20', ' ', url_string)
+    url_string = re.sub(r'%0A', '\n', url_string)
+    return url_string
+
+samples = (
+    ("plain", "thanks"),
+    ("form", "This+is+an+exciting+new+MOTD%21"),
+    ("escaped", "caf%C3%A9%20%E2%82%AC%2050%25%20off%3A%20a%2Fb%3Fc%3Dd%26e"),
+    ("long", "Line+one%0ALine+two%0A" * 10),
+)
+decoders = (("url_decode", url_decode), ("url_parse", url_parse),
+            ("unquote", unquote), ("RequestParser.unquote", parser_unquote))
+ROUNDS = 200
+
+print("url_decode loop:", "plain Python" if _decode is _decode_py else "viper")
+for sampleName, sample in samples:
+    for name, fn in decoders:
+        start = ticks_us()
+        for _ in range(ROUNDS):
+            result = fn(sample)
+        us = ticks_diff(ticks_us(), start) / ROUNDS
+        print("%-8s %-22s %8.1f us  %r" % (sampleName, name, us, result[:24]))
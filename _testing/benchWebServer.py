@@ -0,0 +1,291 @@
+"""
+    benchWebServer
+    Load generator and benchmark for web.WebServer, run on a computer rather than the ESP32.
+
+    python _testing/benchWebServer.py [options]
+        Starts the server (uploadToEsp/web/WebServer.py with stand-in data sources) in a
+        child process under the same Python, drives it with --clients concurrent clients
+        for --duration secs and writes the results as JSON to --out, e.g. to compare
+        branches before flashing devices:
+            python _testing/benchWebServer.py --clients 8 --mix data=5,static=4,action=1 --out before.json
+
+    python _testing/benchWebServer.py server [--port 8080]
+        Just the server, e.g. under the MicroPython unix port from the repo root:
+            micropython _testing/benchWebServer.py server
+        then point the client at it from CPython with --url http://localhost:8080
+
+    The mix weights the three kinds of request: "data" GETs /data, "static" GETs one of the
+    --static files (gzip accepted, as a browser would), "action" POSTs a message form to
+    /action (which then serves thanks.html). Clients keep their connection open unless
+    --close is given. Reported: requests/s, latency p50/p95/p99/max, errors by kind,
+    and the server's peak memory - resident set (VmHWM) if we started it, and the lowest
+    gc.mem_free() from its /metrics (only meaningful under MicroPython; CPython gets a
+    fixed stand-in value).
+"""
+import sys
+import os
+
+try:
+    REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+except AttributeError:
+    REPO = "." # MicroPython has no os.path - run it from the repo root
+UPLOAD = REPO + "/uploadToEsp"
+
+def hostStandIns():
+    # What CPython lacks that the MicroPython code on the board relies on
+    import time, gc, asyncio
+    try:
+        import micropython
+    except ImportError:
+        micropython = type(sys)("micropython")
+        micropython.const = lambda x: x
+        sys.modules["micropython"] = micropython
+    # lib/ESPLogRecord builds on MicroPython's logging.LogRecord, which CPython's isn't
+    espLogRecord = type(sys)("ESPLogRecord")
+    espLogRecord.ESPLogRecord = type("ESPLogRecord", (), {})
+    sys.modules["ESPLogRecord"] = espLogRecord
+    if not hasattr(time, "ticks_ms"):
+        time.ticks_ms = lambda: int(time.monotonic() * 1000) & 0x3fffffff
+        time.ticks_us = lambda: int(time.monotonic() * 1000000) & 0x3fffffff
+        time.ticks_diff = lambda a, b: ((a - b + 0x20000000) & 0x3fffffff) - 0x20000000
+    if not hasattr(time, "ticks_add"):
+        time.ticks_add = lambda t, delta: (t + delta) & 0x3fffffff
+    if not hasattr(gc, "mem_free"):
+        gc.mem_free = lambda: 1000000 # No heap limit here; load shedding stays out of the way
+    if not hasattr(asyncio, "sleep_ms"):
+        asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+
+def runServer(port, docroot):
+    sys.path[:0] = [UPLOAD, UPLOAD + "/lib"]
+    if sys.implementation.name != "micropython":
+        hostStandIns()
+    import asyncio, logging, random
+    logging.basicConfig(level=logging.WARNING)
+    from web.WebServer import WebServer
+
+    def getValues(): # Stand-in for the sensors
+        return {"temp": 20 + random.random(), "RH": 50 + random.random(), "CO2": 400 + random.randint(0, 50)}
+
+    async def main():
+        WebServer([getValues], None, docroot, port=port)
+        while True:
+            await asyncio.sleep(3600)
+    asyncio.run(main())
+
+def percentile(sortedValues, p):
+    if not sortedValues:
+        return None
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * p / 100))]
+
+async def fetch(host, port, path):
+    # One-off request on its own connection, for /metrics and the like
+    import asyncio
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(("GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n" % (path, host)).encode())
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    return data.split(b"\r\n\r\n", 1)[-1].decode()
+
+class Client:
+
+    def __init__(self, host, port, requests, keepAlive, results):
+        self.host = host
+        self.port = port
+        self.requests = requests	# [(kind, bytes to send)], picked from at random
+        self.keepAlive = keepAlive
+        self.results = results
+        self.reader = self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, data):
+        # Returns (status, keep-alive)
+        import asyncio
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(data)
+        await self.writer.drain()
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split(" ")[1])
+        length = 0
+        keepAlive = True
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            name = name.lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "connection" and value.strip().lower() == "close":
+                keepAlive = False
+        if length:
+            await self.reader.readexactly(length)
+        return status, keepAlive
+
+    async def run(self, until):
+        import asyncio, random, time
+        while time.monotonic() < until:
+            kind, data = random.choice(self.requests)
+            start = time.monotonic()
+            try:
+                status, keepAlive = await asyncio.wait_for(self.request(data), 10)
+                self.results.record(kind, (time.monotonic() - start) * 1000, status)
+                if not keepAlive or not self.keepAlive:
+                    await self.close()
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError, IndexError) as e:
+                self.results.record(kind, (time.monotonic() - start) * 1000, type(e).__name__)
+                await self.close()
+                await asyncio.sleep(0.05) # Don't hammer a server that's turning us away
+        await self.close()
+
+class Results:
+
+    def __init__(self):
+        self.latencies = {}	# kind -> [ms]
+        self.errors = {}	# "kind:status or exception" -> count
+
+    def record(self, kind, ms, status):
+        if status == 200:
+            self.latencies.setdefault(kind, []).append(ms)
+        else:
+            key = "%s:%s" % (kind, status)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def summary(self, elapsed):
+        def stats(values):
+            values = sorted(values)
+            return {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+                    "p99": percentile(values, 99), "max": values[-1] if values else None,
+                    "mean": sum(values) / len(values) if values else None}
+        allLatencies = [ms for values in self.latencies.values() for ms in values]
+        ok = len(allLatencies)
+        errors = sum(self.errors.values())
+        return {"requests": ok + errors, "ok": ok, "errors": errors,
+                "errorRate": errors / (ok + errors) if ok + errors else 0,
+                "requestsPerSec": ok / elapsed, "latencyMs": stats(allLatencies),
+                "byKind": {kind: stats(values) for kind, values in self.latencies.items()},
+                "errorsByKind": self.errors}
+
+def buildRequests(host, mix, staticFiles, keepAlive):
+    connection = "keep-alive" if keepAlive else "close"
+    requests = []
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind == "data":
+            made = [("data", "GET /data HTTP/1.1\r\nHost: %s\r\nConnection: %s\r\n\r\n" % (host, connection))]
+        elif kind == "static":
+            made = [("static", "GET %s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: gzip, deflate\r\nConnection: %s\r\n\r\n"
+                     % (path, host, connection)) for path in staticFiles]
+        elif kind == "action":
+            body = "action=message&MOTD=Benchmark+run+%21"
+            made = [("action", "POST /action HTTP/1.1\r\nHost: %s\r\nConnection: %s\r\n"
+                     "Content-Type: application/x-www-form-urlencoded\r\nContent-Length: %d\r\n\r\n%s"
+                     % (host, connection, len(body), body))]
+        else:
+            raise SystemExit("Unknown request kind in mix: %s" % kind)
+        # Weight is per kind, so spread it over the static files
+        requests += [(k, r.encode()) for k, r in made] * (int(weight or 1) * (len(staticFiles) if kind != "static" else 1))
+    return requests
+
+def peakRssKB(pid):
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def heapFreeMin(metricsText):
+    for line in metricsText.split("\n"):
+        if line.startswith("heap_free_min_bytes "):
+            return int(line.split()[1])
+    return None
+
+def runBenchmark(args):
+    import asyncio, json, subprocess, time, urllib.parse
+    server = None
+    if args.url:
+        url = urllib.parse.urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        host, port = "127.0.0.1", args.port
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "server", "--port", str(port),
+                                   "--docroot", args.docroot])
+    results = Results()
+    requests = buildRequests(host, args.mix, args.static.split(","), not args.close)
+
+    async def main():
+        # Wait for the server to come up
+        for _ in range(50):
+            try:
+                await fetch(host, port, "/data")
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        else:
+            raise SystemExit("Server not answering on %s:%d" % (host, port))
+        start = time.monotonic()
+        clients = [Client(host, port, requests, not args.close, results) for _ in range(args.clients)]
+        await asyncio.gather(*[c.run(start + args.duration) for c in clients])
+        elapsed = time.monotonic() - start
+        return elapsed, await fetch(host, port, "/metrics")
+
+    try:
+        elapsed, metricsText = asyncio.run(main())
+        summary = results.summary(elapsed)
+        summary["server"] = {"peakRssKB": peakRssKB(server.pid) if server else None,
+                             "heapFreeMinBytes": heapFreeMin(metricsText)}
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    summary["config"] = {"clients": args.clients, "duration": args.duration, "mix": args.mix,
+                         "static": args.static, "keepAlive": not args.close, "url": args.url,
+                         "python": sys.implementation.name + " " + sys.version.split()[0],
+                         "commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    with open(args.out, "w") as f:
+        json.dump(summary, f, indent=2)
+    latency = summary["latencyMs"]
+    print("%d requests in %.1fs: %.1f req/s, %d errors (%.1f%%)" % (summary["requests"], elapsed,
+          summary["requestsPerSec"], summary["errors"], summary["errorRate"] * 100))
+    if latency["count"]:
+        print("latency ms p50 %.1f p95 %.1f p99 %.1f max %.1f" % (latency["p50"], latency["p95"],
+              latency["p99"], latency["max"]))
+    print("server peak RSS %s KB, lowest heap free %s; results in %s" % (summary["server"]["peakRssKB"],
+          summary["server"]["heapFreeMinBytes"], args.out))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "server":
+        # Kept free of argparse so it runs under the MicroPython unix port
+        port = 8080
+        docroot = UPLOAD + "/webdocs"
+        for i in range(2, len(sys.argv) - 1):
+            if sys.argv[i] == "--port":
+                port = int(sys.argv[i + 1])
+            elif sys.argv[i] == "--docroot":
+                docroot = sys.argv[i + 1]
+        runServer(port, docroot)
+    else:
+        import argparse
+        parser = argparse.ArgumentParser(description="Load test web.WebServer")
+        parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+        parser.add_argument("--duration", type=float, default=10, help="secs to run for")
+        parser.add_argument("--mix", default="data=5,static=4,action=1", help="kind=weight,...")
+        parser.add_argument("--static", default="/index.html,/config.html,/gauge.min.js",
+                            help="static files to fetch")
+        parser.add_argument("--close", action="store_true", help="new connection for every request")
+        parser.add_argument("--port", type=int, default=8080, help="port for the server we start")
+        parser.add_argument("--docroot", default=UPLOAD + "/webdocs", help="docroot for the server we start")
+        parser.add_argument("--url", help="benchmark a server that's already running instead")
+        parser.add_argument("--out", default="bench.json", help="JSON results file")
+        runBenchmark(parser.parse_args())
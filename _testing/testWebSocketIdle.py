@@ -0,0 +1,143 @@
+"""
+    testWebSocketIdle
+    Checks the /ws idle timeout, run on a computer rather than the ESP32:
+
+    python _testing/testWebSocketIdle.py [--heartbeat 1]
+
+    Starts web.WebServer in this process with a short eventHeartbeat and data that never
+    changes, so the only frames the server sends are its pings. Then
+        - a client that answers every ping but sends nothing else must still be connected
+          well past 2 x heartbeat, and get data back when it finally asks for it
+        - a client that ignores the pings must be closed (code 1000) at about 2 x heartbeat
+    Exits 0 if both hold.
+"""
+import sys
+import os
+import time
+import struct
+import base64
+import argparse
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UPLOAD = os.path.join(REPO, "uploadToEsp")
+sys.path[:0] = [UPLOAD, os.path.join(UPLOAD, "lib"), os.path.dirname(os.path.abspath(__file__))]
+from benchWebServer import hostStandIns
+
+async def connect(port):
+    import asyncio
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write(("GET /ws HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                  "Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n" % key).encode())
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    if b" 101 " not in head.split(b"\r\n")[0]:
+        raise ValueError("no upgrade: %r" % head)
+    return reader, writer
+
+def frame(opcode, payload=b""):
+    # Client frames are masked; payloads here are all short
+    mask = os.urandom(4)
+    return bytes([0x80 | opcode, 0x80 | len(payload)]) + mask + bytes(b ^ mask[i & 3] for i, b in enumerate(payload))
+
+async def readFrame(reader):
+    hdr = await reader.readexactly(2)
+    length = hdr[1] & 0x7f
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    return hdr[0] & 0x0f, await reader.readexactly(length)
+
+async def listen(port, seconds, answerPings):
+    # Returns (secs until the server closed, None if it didn't, close code, pings seen)
+    import asyncio
+    reader, writer = await connect(port)
+    start = time.monotonic()
+    pings = 0
+    try:
+        while True:
+            left = start + seconds - time.monotonic()
+            if left <= 0:
+                return None, None, pings
+            try:
+                opcode, payload = await asyncio.wait_for(readFrame(reader), left)
+            except asyncio.TimeoutError:
+                return None, None, pings
+            if opcode == 0x9:
+                pings += 1
+                if answerPings:
+                    writer.write(frame(0xA, payload))
+                    await writer.drain()
+            elif opcode == 0x8:
+                code = struct.unpack("!H", payload[:2])[0] if len(payload) >= 2 else None
+                return time.monotonic() - start, code, pings
+    finally:
+        writer.close()
+
+async def askForData(port, answerPings, wait):
+    # Answers pings for wait secs, then sends {"type": "data"}; True if the data comes back
+    import asyncio
+    reader, writer = await connect(port)
+    try:
+        until = time.monotonic() + wait
+        while True:
+            left = until - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                opcode, payload = await asyncio.wait_for(readFrame(reader), left)
+            except asyncio.TimeoutError:
+                break
+            if opcode == 0x9 and answerPings:
+                writer.write(frame(0xA, payload))
+                await writer.drain()
+            elif opcode == 0x8:
+                return False
+        writer.write(frame(0x1, b'{"type": "data"}'))
+        await writer.drain()
+        while True:
+            opcode, payload = await asyncio.wait_for(readFrame(reader), 5)
+            if opcode == 0x1:
+                return payload.startswith(b'{"type": "data"')
+            if opcode == 0x8:
+                return False
+    finally:
+        writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocket idle timeout check")
+    parser.add_argument("--heartbeat", type=float, default=1, help="the server's eventHeartbeat, secs")
+    parser.add_argument("--port", type=int, default=8091)
+    args = parser.parse_args()
+    hostStandIns()
+    import asyncio, logging
+    logging.basicConfig(level=logging.WARNING)
+    from web.WebServer import WebServer
+    heartbeat = args.heartbeat
+    failed = []
+
+    async def run():
+        WebServer([lambda: {"temp": 21.5}], None, os.path.join(UPLOAD, "webdocs"), port=args.port,
+                  eventHeartbeat=heartbeat)
+        await asyncio.sleep(0.2)
+        closedAt, code, pings = await listen(args.port, 4 * heartbeat, True)
+        print("answering pings: %d pings in %.1f secs, %s" % (pings, 4 * heartbeat,
+              "still open" if closedAt is None else "closed at %.1f secs, code %s" % (closedAt, code)))
+        if closedAt is not None or pings < 2:
+            failed.append("a client answering pings was disconnected")
+        if not await askForData(args.port, True, 3 * heartbeat):
+            failed.append("no data after 3 x heartbeat answering pings")
+        closedAt, code, pings = await listen(args.port, 6 * heartbeat, False)
+        print("ignoring pings: %s" % ("still open" if closedAt is None else "closed at %.1f secs, code %s" % (closedAt, code)))
+        if closedAt is None or code != 1000 or not 2 * heartbeat - 0.1 <= closedAt < 3 * heartbeat:
+            failed.append("a client ignoring pings wasn't closed at 2 x heartbeat")
+
+    asyncio.run(run())
+    for f in failed:
+        print("FAIL:", f)
+    print("ok" if not failed else "failed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
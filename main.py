@@ -50,11 +50,12 @@ from printMem import printMem
 from lcd.LCD import LCD
 
 from web.WebServer import WebServer
-from web.url_parse import url_parse
 from web.MOTD import MOTD
 
 #from sensors.ds18b20 import DS18B20
 from sensors.ens160aht21 import ENS160AHT21
+from sensors.Sensor import Sensor
+from sensors.CompressedSampleLog import CompressedSampleLog
 
 from button.pushbutton import Pushbutton
 
@@ -204,12 +205,16 @@ async def main():
 
     # 4
     #ds = DS18B20(interval=10, pin=33) # Update sensor values every 10 seconds
-    ens = ENS160AHT21(interval = 30)
+    # Samples are kept on flash too, for /history?from=&to= - and for after a reboot
+    sampleLog = CompressedSampleLog("/samples") # 512KB at most
+    ens = ENS160AHT21(interval = 30, sampleLog=sampleLog)
 
     # 5
     #ws = WebServer([ds.getValues,ens.getValues], actionHandler, "/webdocs") # default to port 80
     #ws = WebServer([ds.getValues], actionHandler, "/webdocs") # default to port 80
-    ws = WebServer([ens.getValues,], actionHandler, "/webdocs") # default to port 80
+    # Sensor.newData lets the web page's /events stream push new values as soon as they arrive
+    # Sensors themselves rather than their getValues, so /data?since=<seq> can tell what's changed
+    ws = WebServer([ens,], actionHandler, "/webdocs", dataEvent=Sensor.newData) # default to port 80
         
     # 6
     # main task control loop
@@ -48,7 +48,6 @@ from printMem import printMem
 from lcd.LCD import LCD
 
 from web.WebServer import WebServer
-from web.url_parse import url_parse
 
 from sensors.ds18b20 import DS18B20
 from sensors.ens160aht21 import ENS160AHT21
@@ -118,9 +117,9 @@ def actionHandler(action, params):
         if action == "network":
             # Network config
             # hostname, ssid, password
-            hostname = url_parse(params['hostname'])
-            ssid = url_parse(params['ssid'])
-            password = url_parse(params['password'])
+            hostname = params['hostname']
+            ssid = params['ssid']
+            password = params['password']
             # not sure what to do with the hostname for now! Would have to put in NetCreds...
             if ssid != "" and password != "":
                 WiFiConnection.setNetCreds(ssid, password)
@@ -128,8 +127,7 @@ def actionHandler(action, params):
         elif action == "message":
             # MOTD
             logger.debug("actionHandler: MOTD type:%s, value:%s", type(params['MOTD']), params['MOTD'])
-            logger.debug("actionHandler: MOTD parsed:%s", url_parse(params['MOTD']))
-            MOTD = url_parse(params['MOTD'])
+            MOTD = params['MOTD']
             logger.info(const("actionHandler: MOTD set: %s "), MOTD )
     
         return("thanks.html")
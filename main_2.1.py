@@ -50,7 +50,6 @@ from printMem import printMem
 from lcd.LCD import LCD
 
 from web.WebServer import WebServer
-from web.url_parse import url_parse
 from web.MOTD import MOTD
 
 #from sensors.ds18b20 import DS18B20
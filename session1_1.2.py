@@ -22,7 +22,6 @@ from flashLed import flashLed
 from printMem import printMem
 from lcd.LCD import LCD
 from web.WebServer import WebServer
-from web.url_parse import url_parse
 from sensors.ens160aht21 import ENS160AHT21
 from button.pushbutton import Pushbutton
 
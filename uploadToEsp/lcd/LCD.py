@@ -40,6 +40,9 @@ except ImportError:
     pass
 
 from lcd.esp8266_i2c_lcd import I2cLcd
+from Metrics import metrics
+_rowsWritten = metrics.counter("lcd_rows_written_total", "LCD rows rewritten")
+_i2cUs = metrics.counter("lcd_i2c_us_total", "Time spent writing to the LCD over I2C, usecs")
 
 class LCD(I2cLcd):
 
@@ -80,12 +83,18 @@ class LCD(I2cLcd):
             for row in range(self.rows):
                 if self.dirty[row]:
                     msg = self[row]
+                    start = time.ticks_us()
                     self.move_to(0,row)
+                    i2cUs = time.ticks_diff(time.ticks_us(), start)
                     # Write each char of msg to the relevant row
                     for thisbyte in msg:
+                        start = time.ticks_us()
                         self.putchar(thisbyte)
+                        i2cUs += time.ticks_diff(time.ticks_us(), start)
                         await asyncio.sleep_ms(0)  # Reshedule ASAP
                     self.dirty[row] = False
+                    _rowsWritten.inc()
+                    _i2cUs.inc(n=i2cUs)
             await asyncio.sleep_ms(20)  # Give other coros a look-in
             
     def _checkKillScroll(self, line):
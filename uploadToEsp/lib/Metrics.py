@@ -0,0 +1,151 @@
+"""
+    Metrics
+    Registry of counters, gauges and histograms, rendered as Prometheus text
+    (the WebServer serves it at /metrics) so you can see where the time goes
+    without DEBUG logging.
+
+    Everything registers with the shared registry when its module is imported:
+        from Metrics import metrics
+        _requests = metrics.counter("http_requests_total", "Requests served", ("route", "status"))
+        _requests.inc("/data", "200")
+        _latency = metrics.histogram("http_request_duration_ms", "Request time", (10, 100, 1000), ("route",))
+        _latency.observe(elapsed, "/data")
+
+    counter(name, help, labels)		inc(*labelValues, n=1)
+    gauge(name, help, labels, fn)	set(value, *labelValues), or fn() called at render time
+    histogram(name, help, buckets, labels)	observe(value, *labelValues)
+        Bucket counts are kept in an array per label set; the buckets are the upper
+        bounds, +Inf is added
+    collect(prefix, fn)
+        fn() returns a dict of numbers, rendered as gauges named prefix_key - handy
+        for existing stats dicts
+    sampleHeap()
+        Records gc.mem_free() and its lowest/highest values since startup; called on
+        render, and by anything busy enough to be worth sampling from
+"""
+import gc
+from array import array
+
+def _labelText(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('%s="%s"' % (names[i], values[i]) for i in range(len(names))) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}	# label values tuple -> value
+
+    def inc(self, *labelValues, n=1):
+        self.values[labelValues] = self.values.get(labelValues, 0) + n
+
+    def render(self, out):
+        for labelValues, value in self.values.items():
+            out.append("%s%s %s\n" % (self.name, _labelText(self.labels, labelValues), value))
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, *labelValues):
+        self.values[labelValues] = value
+
+    def render(self, out):
+        if self.fn is not None:
+            self.values[()] = self.fn()
+        super().render(out)
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = {}	# label values tuple -> array of counts per bucket, +Inf last
+        self.sums = {}		# label values tuple -> sum of the values observed
+
+    def observe(self, value, *labelValues):
+        counts = self.counts.get(labelValues)
+        if counts is None:
+            counts = self.counts[labelValues] = array('I', [0] * (len(self.buckets) + 1))
+            self.sums[labelValues] = 0
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        counts[i] += 1
+        self.sums[labelValues] += value
+
+    def render(self, out):
+        names = self.labels + ("le",)
+        for labelValues, counts in self.counts.items():
+            total = 0
+            for i in range(len(counts)):
+                total += counts[i]
+                le = str(self.buckets[i]) if i < len(self.buckets) else "+Inf"
+                out.append("%s_bucket%s %d\n" % (self.name, _labelText(names, labelValues + (le,)), total))
+            labelText = _labelText(self.labels, labelValues)
+            out.append("%s_sum%s %s\n" % (self.name, labelText, self.sums[labelValues]))
+            out.append("%s_count%s %d\n" % (self.name, labelText, total))
+
+class Metrics:
+
+    def __init__(self):
+        self.metrics = {}		# name -> metric, in registration order where dicts keep it
+        self.collectors = []	# (prefix, fn)
+        self.memFree = self.memLow = self.memHigh = gc.mem_free()
+        self.gauge("heap_free_bytes", "gc.mem_free() when last sampled", fn=lambda: self.memFree)
+        self.gauge("heap_free_min_bytes", "Lowest gc.mem_free() seen", fn=lambda: self.memLow)
+        self.gauge("heap_free_max_bytes", "Highest gc.mem_free() seen", fn=lambda: self.memHigh)
+
+    def _register(self, metric):
+        # Registering the same name again (e.g. a second instance of a class) shares the first
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self._register(Gauge(name, help, labels, fn))
+
+    def histogram(self, name, help, buckets, labels=()):
+        return self._register(Histogram(name, help, buckets, labels))
+
+    def collect(self, prefix, fn):
+        self.collectors.append((prefix, fn))
+
+    def sampleHeap(self):
+        m = gc.mem_free()
+        self.memFree = m
+        if m < self.memLow:
+            self.memLow = m
+        if m > self.memHigh:
+            self.memHigh = m
+
+    def render(self):
+        self.sampleHeap()
+        out = []
+        for metric in self.metrics.values():
+            out.append("# HELP %s %s\n# TYPE %s %s\n" % (metric.name, metric.help, metric.name, metric.kind))
+            metric.render(out)
+        for prefix, fn in self.collectors:
+            for k, v in fn().items():
+                if isinstance(v, (int, float)):
+                    out.append("# TYPE %s_%s gauge\n%s_%s %s\n" % (prefix, k, prefix, k, v))
+        return "".join(out)
+
+metrics = Metrics()
@@ -0,0 +1,237 @@
+"""
+    CompressedSampleLog
+    SampleLog that stores samples a few bytes each rather than 12 bytes a value, so the
+    same flash holds months rather than days. Same add()/query() as SampleLog.
+
+    Each sample is encoded as
+        number of values			varint (0 ends the block)
+        time delta-of-delta		zigzag varint - 1 byte while the interval is steady
+        per value: channel id	byte
+                   value delta	zigzag varint of the change in round(value * scale)
+    so a slowly changing reading costs 2 bytes. Values are kept to 1/scale (0.01 by
+    default) - far finer than the sensors measure.
+
+    Blocks are 1024 bytes and each starts from scratch (time and values as deltas from
+    0, the second time as a plain delta), so a query can start at any block, and a
+    damaged block loses only itself. A sample that won't fit in what's left of a block
+    starts the next one; the rest is zeros. On start the last block is decoded to pick
+    up where it left off - if it ends part way through a sample, writing carries on in
+    a new segment.
+"""
+from sensors.SampleLog import SampleLog
+
+CBLOCK = 1024
+
+_INF = float("inf")
+
+def _numeric(value):
+    return isinstance(value, (int, float)) and value == value and value != _INF and value != -_INF
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+def _unzigzag(z):
+    return z >> 1 if not z & 1 else -((z + 1) >> 1)
+
+def _putVarint(buf, pos, n):
+    while n >= 0x80:
+        buf[pos] = (n & 0x7f) | 0x80
+        n >>= 7
+        pos += 1
+    buf[pos] = n
+    return pos + 1
+
+def _getVarint(buf, pos, end):
+    # (value, position after it), or position -1 if it runs past end
+    n = 0
+    shift = 0
+    while pos < end:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+    return 0, -1
+
+class CompressedSampleLog(SampleLog):
+    SUFFIX = ".z"
+    BLOCK_SIZE = CBLOCK
+    READ_SIZE = CBLOCK
+
+    def __init__(self, path="/samples", segmentBlocks=64, maxSegments=8, batchRecords=32, flushInterval=60, scale=100):
+        self.scale = scale
+        self.sample = bytearray(256)	# One sample, encoded
+        self.prevTime = 0				# Encoder state, reset at the start of each block
+        self.prevDelta = 0
+        self.prevValues = {}			# channel id -> last value * scale
+        self.used = CBLOCK				# Bytes of the current block used - none open yet
+        self.blockCount = 0				# Blocks started in the current segment
+        self.bytesLogged = 0
+        super().__init__(path, segmentBlocks, maxSegments, batchRecords, flushInterval)
+
+    def _encode(self, t, values, n):
+        sample = self.sample
+        pos = _putVarint(sample, 0, n)
+        pos = _putVarint(sample, pos, _zigzag(t - self.prevTime - self.prevDelta))
+        scale = self.scale
+        for name, value in values.items():
+            if _numeric(value):
+                channel = self.channels.get(name)
+                if channel is not None:
+                    q = int(round(value * scale))
+                    sample[pos] = channel
+                    pos = _putVarint(sample, pos + 1, _zigzag(q - self.prevValues.get(channel, 0)))
+        return pos
+
+    def _append(self, t, values):
+        n = 0
+        for name, value in values.items():
+            if _numeric(value) and self._channel(name) is not None:
+                n += 1
+        if n == 0:
+            return
+        if len(self.sample) < 16 + n * 11: # Varints of up to 64 bits
+            self.sample = bytearray(16 + n * 11)
+        length = self._encode(t, values, n)
+        if self.used + length > CBLOCK:
+            if self.used < CBLOCK:
+                self._pad(CBLOCK - self.used)
+            if self.blockCount >= self.segmentBlocks:
+                self.flush()
+                self._newSegment()
+            # New block: start again from zero, so it can be decoded on its own
+            self.blockCount += 1
+            self.used = 0
+            self.prevTime = 0
+            self.prevDelta = 0
+            self.prevValues.clear()
+            self.segments[-1][1].append(t)
+            length = self._encode(t, values, n)
+        # Move the state on to this sample; after a block's first, the delta starts again from 0
+        self.prevDelta = t - self.prevTime if self.used else 0
+        self.prevTime = t
+        scale = self.scale
+        for name, value in values.items():
+            if _numeric(value):
+                channel = self.channels.get(name)
+                if channel is not None:
+                    self.prevValues[channel] = int(round(value * scale))
+        self._put(self.sample, length)
+        self.used += length
+        self.logged += n
+        self.bytesLogged += length
+
+    def _put(self, data, length):
+        pos = 0
+        while pos < length:
+            room = len(self.buf) - self.bufLen
+            if room == 0:
+                self.flush()
+                continue
+            k = min(room, length - pos)
+            self.buf[self.bufLen:self.bufLen + k] = data[pos:pos + k]
+            self.bufLen += k
+            pos += k
+
+    def _pad(self, length):
+        for i in range(length):
+            if self.bufLen == len(self.buf):
+                self.flush()
+            self.buf[self.bufLen] = 0
+            self.bufLen += 1
+
+    def _newSegment(self):
+        super()._newSegment()
+        self.used = CBLOCK
+        self.blockCount = 0
+
+    def _segmentFull(self):
+        return False # _append moves on when the last block of the segment fills
+
+    def getStats(self):
+        stats = super().getStats()
+        stats["bytesLogged"] = self.bytesLogged
+        return stats
+
+    def _firstTime(self, f, block):
+        f.seek(block * CBLOCK)
+        header = f.read(11)
+        n, pos = _getVarint(header, 0, len(header))
+        if pos < 0 or n == 0:
+            return None
+        dod, pos = _getVarint(header, pos, len(header))
+        if pos < 0:
+            return None
+        return _unzigzag(dod) # The first time in a block is a delta from 0
+
+    def _decode(self, buf, end, prevValues):
+        # (time, channel id, value * scale) of each value in buf[:end], which starts a block;
+        # leaves self.decoded as (position, time, delta) after the last complete sample, and
+        # self.decodeClean False if it ended part way through one
+        pos = 0
+        prevTime = 0
+        prevDelta = 0
+        self.decoded = (0, 0, 0)
+        self.decodeClean = True
+        while pos < end:
+            n, pos = _getVarint(buf, pos, end)
+            if pos < 0:
+                self.decodeClean = False
+                return
+            if n == 0:
+                return # Padding
+            dod, pos = _getVarint(buf, pos, end)
+            if pos < 0:
+                self.decodeClean = False
+                return
+            prevDelta += _unzigzag(dod)
+            first = prevTime == 0
+            prevTime += prevDelta
+            if first:
+                prevDelta = 0
+            for i in range(n):
+                if pos >= end:
+                    self.decodeClean = False
+                    return
+                channel = buf[pos]
+                z, pos = _getVarint(buf, pos + 1, end)
+                if pos < 0:
+                    self.decodeClean = False
+                    return
+                q = prevValues.get(channel, 0) + _unzigzag(z)
+                prevValues[channel] = q
+                yield prevTime, channel, q
+            self.decoded = (pos, prevTime, prevDelta)
+
+    def _blockRecords(self, f, block, buf):
+        f.seek(block * CBLOCK)
+        end = f.readinto(buf)
+        scale = self.scale
+        for t, channel, q in self._decode(buf, end, {}):
+            yield t, channel, q / scale
+
+    def _resume(self, f, size):
+        if size == 0:
+            return None
+        blocks = (size + CBLOCK - 1) // CBLOCK
+        buf = bytearray(CBLOCK)
+        f.seek((blocks - 1) * CBLOCK)
+        end = f.readinto(buf)
+        prevValues = {}
+        for sample in self._decode(buf, end, prevValues):
+            pass
+        pos, prevTime, prevDelta = self.decoded
+        if not self.decodeClean or prevTime == 0:
+            return None
+        self.blockCount = blocks
+        if end < CBLOCK:
+            if pos != end:
+                return None # Something after the last good sample
+            self.used = end
+            self.prevTime = prevTime
+            self.prevDelta = prevDelta
+            self.prevValues = prevValues
+        else:
+            self.used = CBLOCK # Full, the next sample starts a new block
+        return prevTime
@@ -0,0 +1,110 @@
+"""
+    Rollup
+    Count, sum, min and max of each sensor value per minute, quarter hour, hour and day
+    (or whatever levels it's given), in fixed size rings of buckets - so a week of CO2
+    fits in a couple of KB, and adding a sample costs the same however long it's run.
+
+    __init__
+        levels - (bucket secs, buckets kept) for each resolution, finest first
+        channels - the value names to roll up, None for every numeric one. Worth
+            giving: status codes (e.g. the ENS160's Validity) cost as much as readings
+
+    add(t, values)
+        Adds a sample at time t (secs) to the current bucket of every level, for every
+        numeric value in the dict. Buckets are aligned on multiples of their length;
+        moving into a new one clears it (and any skipped) in place
+    getRollup(channel, resolution, n)
+        The last n buckets of a resolution (bucket secs) that have samples, oldest
+        first, as (start time, count, mean, min, max) tuples
+
+    Memory: 14 bytes per bucket per value, plus 4 per bucket for the start times - with
+    LEVELS, about 3 KB a value, so Sensors only have rollups when they ask for them
+"""
+from array import array
+
+LEVELS = ((60, 60), (900, 96), (3600, 48), (86400, 14))	# 1 hour, 1 day, 2 days, 2 weeks
+
+_INF = float("inf")
+
+class Rollup:
+
+    def __init__(self, levels=LEVELS, channels=None):
+        self.levels = levels
+        self.names = channels
+        self.starts = [array('I', [0] * size) for secs, size in levels]	# Bucket start time per level
+        self.current = [-1] * len(levels)	# Bucket number (t // secs) being filled at each level
+        self.channels = {}	# value name -> per level [counts, sums, mins, maxs]
+
+    def _newChannel(self):
+        channel = []
+        for secs, size in self.levels:
+            channel.append([array('H', [0] * size), array('f', [0] * size),
+                            array('f', [_INF] * size), array('f', [-_INF] * size)])
+        return channel
+
+    def _advance(self, level, bucket):
+        # Clear the buckets from the one after current up to bucket, at most the whole ring
+        secs, size = self.levels[level]
+        first = self.current[level] + 1
+        if bucket - first >= size:
+            first = bucket - size + 1
+        starts = self.starts[level]
+        for b in range(first, bucket + 1):
+            i = b % size
+            starts[i] = b * secs
+            for channel in self.channels.values():
+                counts, sums, mins, maxs = channel[level]
+                counts[i] = 0
+                sums[i] = 0
+                mins[i] = _INF
+                maxs[i] = -_INF
+        self.current[level] = bucket
+
+    def add(self, t, values):
+        for level in range(len(self.levels)):
+            bucket = t // self.levels[level][0]
+            if bucket > self.current[level]:
+                self._advance(level, bucket)
+            # A clock set backwards just carries on filling the current bucket
+        for k, v in values.items():
+            if not isinstance(v, (int, float)) or (self.names is not None and k not in self.names):
+                continue
+            channel = self.channels.get(k)
+            if channel is None:
+                channel = self.channels[k] = self._newChannel()
+            for level in range(len(self.levels)):
+                i = self.current[level] % self.levels[level][1]
+                counts, sums, mins, maxs = channel[level]
+                if counts[i] < 0xffff:
+                    counts[i] += 1
+                    sums[i] += v
+                    if v < mins[i]:
+                        mins[i] = v
+                    if v > maxs[i]:
+                        maxs[i] = v
+
+    def resolutions(self):
+        return [secs for secs, size in self.levels]
+
+    def getRollup(self, channel, resolution, n=None):
+        c = self.channels.get(channel)
+        if c is None:
+            return []
+        for level in range(len(self.levels)):
+            secs, size = self.levels[level]
+            if secs == resolution:
+                break
+        else:
+            return []
+        if self.current[level] < 0:
+            return []
+        if n is None or n > size:
+            n = size
+        counts, sums, mins, maxs = c[level]
+        starts = self.starts[level]
+        rollup = []
+        for b in range(self.current[level] - n + 1, self.current[level] + 1):
+            i = b % size
+            if counts[i] and starts[i] == b * secs:
+                rollup.append((starts[i], counts[i], sums[i] / counts[i], mins[i], maxs[i]))
+        return rollup
@@ -0,0 +1,300 @@
+"""
+    SampleLog
+    Append-only log of sensor samples on flash, so history survives a reboot.
+
+    Records are 12 bytes - time (secs), value (32 bit float), channel id, a marker byte
+    and a check over time and channel - packed into 4096 byte blocks (341 a block, the
+    last 4 bytes padding) in numbered segment files under path:
+        /samples/channels.txt	one value name a line, the line number is its channel id
+        /samples/00000001.bin	segments, at most segmentBlocks blocks each
+    Samples are batched in RAM and written batchRecords at a time (and every
+    flushInterval secs by run()) to spare the flash; once there are more than
+    maxSegments segments the oldest is deleted.
+
+    On start the segments are indexed by the time of the first record of each block,
+    so a query seeks straight to the right block. A segment that ends in a partial or
+    bad record (power lost mid-write) is left as it is - readers skip anything that
+    doesn't check out - and writing carries on in a new one. Samples timed before the
+    last one logged (the clock not set yet) are skipped, so the log stays in time order.
+
+    add(t, values)
+        Logs the numeric values of a sample (the Sensor base class does this)
+    query(fromTime, toTime, channel)
+        Generator of (time, value name, value) from fromTime to toTime inclusive,
+        reading a few hundred bytes at a time; channel None for all of them
+    run()
+        Flush loop, started by __init__ when there's a flushInterval
+
+    The record format is in _append(), _firstTime(), _resume() and _blockRecords();
+    sensors.CompressedSampleLog replaces them with one several times smaller.
+"""
+import asyncio, os, struct
+import logging
+from array import array
+from micropython import const
+
+logger = logging.getLogger(__name__)
+from ESPLogRecord import ESPLogRecord
+logger.record = ESPLogRecord()
+
+from Metrics import metrics
+
+BLOCK = const(4096)
+RECORD = const(12)
+PER_BLOCK = const(341)	# BLOCK // RECORD
+_CHUNK = const(31)		# Records read at a time: 11 chunks a block
+_MARKER = const(0xa5)
+_FORMAT = "<IfBBH"		# time, value, channel, marker, check
+
+def _check(t, channel):
+    return ((t & 0xffff) ^ (t >> 16) ^ (channel * 0x101)) & 0xffff
+
+def _recordCount(size):
+    # Whole records in a file of size bytes
+    n = (size % BLOCK) // RECORD
+    return size // BLOCK * PER_BLOCK + (n if n < PER_BLOCK else PER_BLOCK)
+
+class SampleLog:
+    SUFFIX = ".bin"		# Segment file names - each format has its own
+    BLOCK_SIZE = BLOCK
+    READ_SIZE = _CHUNK * RECORD	# Query read buffer
+
+    def __init__(self, path="/samples", segmentBlocks=16, maxSegments=8, batchRecords=32, flushInterval=60):
+        self.path = path
+        self.segmentBlocks = segmentBlocks
+        self.maxSegments = maxSegments
+        self.flushInterval = flushInterval
+        self.buf = bytearray(batchRecords * RECORD + BLOCK - PER_BLOCK * RECORD)	# Room for a block's padding
+        self.bufLen = 0
+        self.channels = {}		# value name -> channel id
+        self.names = []			# channel id -> value name
+        self.segments = []		# [segment number, array of the time of the first record of each block]
+        self.count = 0			# Records in the segment being written, batched ones included
+        self.lastTime = 0
+        self.logged = 0
+        self.skipped = 0
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass # Already there
+        try:
+            with open(path + "/channels.txt") as f:
+                for line in f:
+                    name = line.strip()
+                    if name:
+                        self.channels[name] = len(self.names)
+                        self.names.append(name)
+        except OSError:
+            pass
+        numbers = []
+        for name in os.listdir(path):
+            if name.endswith(self.SUFFIX):
+                try:
+                    numbers.append(int(name[:-len(self.SUFFIX)]))
+                except ValueError:
+                    pass
+        numbers.sort()
+        for number in numbers:
+            self._index(number)
+        self._recover()
+        logger.info(const("SampleLog %s: %d segments, %d channels"), path, len(self.segments), len(self.names))
+        metrics.collect("samplelog", self.getStats)
+        if flushInterval:
+            asyncio.create_task(self.run())
+
+    def _segmentPath(self, number):
+        return "%s/%08d%s" % (self.path, number, self.SUFFIX)
+
+    def _index(self, number):
+        firstTimes = array('I')
+        try:
+            with open(self._segmentPath(number), "rb") as f:
+                size = f.seek(0, 2)
+                for block in range((size + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE):
+                    t = self._firstTime(f, block)
+                    if t is None:
+                        break
+                    firstTimes.append(t)
+        except OSError as e:
+            logger.warning(const("SampleLog couldn't index segment %d: %s"), number, str(e))
+            return
+        if len(firstTimes):
+            self.segments.append([number, firstTimes])
+
+    def _recover(self):
+        # Find where the last segment ends, and whether it can be appended to
+        if not self.segments:
+            self._newSegment()
+            return
+        number = self.segments[-1][0]
+        with open(self._segmentPath(number), "rb") as f:
+            last = self._resume(f, f.seek(0, 2))
+        # Damaged, the last good time is somewhere after the last block started
+        self.lastTime = last if last is not None else self.segments[-1][1][-1]
+        if last is None or self._segmentFull():
+            if last is None:
+                logger.warning(const("SampleLog segment %d has a damaged end, starting a new one"), number)
+            self._newSegment()
+
+    def _firstTime(self, f, block):
+        # Time of the first record in a block, None if it hasn't got one
+        f.seek(block * BLOCK)
+        header = f.read(4)
+        if len(header) < 4:
+            return None
+        return struct.unpack("<I", header)[0]
+
+    def _resume(self, f, size):
+        # Sets up to append to the segment f: returns the time of its last record, or None if
+        # it doesn't end cleanly
+        count = _recordCount(size)
+        if count == 0 or size != count // PER_BLOCK * BLOCK + count % PER_BLOCK * RECORD:
+            return None
+        k = count - 1
+        f.seek(k // PER_BLOCK * BLOCK + k % PER_BLOCK * RECORD)
+        record = f.read(RECORD)
+        if len(record) < RECORD:
+            return None
+        t, value, channel, marker, check = struct.unpack(_FORMAT, record)
+        if marker != _MARKER or check != _check(t, channel):
+            return None
+        self.count = count
+        return t
+
+    def _segmentFull(self):
+        return self.count >= self.segmentBlocks * PER_BLOCK
+
+    def _newSegment(self):
+        number = self.segments[-1][0] + 1 if self.segments else 1
+        self.segments.append([number, array('I')])
+        self.count = 0
+        while len(self.segments) > self.maxSegments:
+            old = self.segments.pop(0)
+            try:
+                os.remove(self._segmentPath(old[0]))
+            except OSError:
+                pass
+
+    def _channel(self, name):
+        channel = self.channels.get(name)
+        if channel is None:
+            if len(self.names) >= 256:
+                return None
+            channel = self.channels[name] = len(self.names)
+            self.names.append(name)
+            try:
+                with open(self.path + "/channels.txt", "a") as f:
+                    f.write(name + "\n")
+            except OSError as e:
+                logger.warning(const("SampleLog couldn't save channel %s: %s"), name, str(e))
+        return channel
+
+    def add(self, t, values):
+        if t < self.lastTime:
+            self.skipped += 1
+            return
+        self.lastTime = t
+        self._append(t, values)
+
+    def _append(self, t, values):
+        for name, value in values.items():
+            if not isinstance(value, (int, float)):
+                continue
+            channel = self._channel(name)
+            if channel is None:
+                continue
+            if self._segmentFull():
+                self.flush()
+                self._newSegment()
+            k = self.count % PER_BLOCK
+            if k == 0:
+                self.segments[-1][1].append(t)
+            struct.pack_into(_FORMAT, self.buf, self.bufLen, t, value, channel, _MARKER, _check(t, channel))
+            self.bufLen += RECORD
+            if k == PER_BLOCK - 1:
+                # Pad to the end of the block, so records never straddle one
+                for i in range(BLOCK - PER_BLOCK * RECORD):
+                    self.buf[self.bufLen] = 0
+                    self.bufLen += 1
+            self.count += 1
+            self.logged += 1
+            if self.bufLen > len(self.buf) - RECORD - (BLOCK - PER_BLOCK * RECORD):
+                self.flush()
+
+    def flush(self):
+        if self.bufLen == 0:
+            return
+        try:
+            with open(self._segmentPath(self.segments[-1][0]), "ab") as f:
+                f.write(memoryview(self.buf)[:self.bufLen])
+        except OSError as e:
+            logger.error(const("SampleLog write failed, %d bytes lost: %s"), self.bufLen, str(e))
+        self.bufLen = 0
+
+    def getStats(self):
+        return {"segments": len(self.segments), "channels": len(self.names),
+                "logged": self.logged, "skipped": self.skipped}
+
+    def _startBlock(self, firstTimes, fromTime):
+        # Last block starting before fromTime - records at fromTime may run on from it
+        lo = 0
+        hi = len(firstTimes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if firstTimes[mid] < fromTime:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1 if lo > 0 else 0
+
+    def query(self, fromTime=0, toTime=0xffffffff, channel=None):
+        self.flush() # So the latest are there too
+        channelId = None
+        if channel is not None:
+            channelId = self.channels.get(channel)
+            if channelId is None:
+                return
+        # A copy: while a slow query is streamed, logging can drop the oldest segment from the
+        # list (and delete its file), which would shift what's left under our indexes
+        segments = list(self.segments)
+        buf = bytearray(self.READ_SIZE) # Each query its own - there can be several streaming at once
+        for s in range(len(segments)):
+            number, firstTimes = segments[s]
+            if not len(firstTimes) or firstTimes[0] > toTime:
+                continue
+            if s + 1 < len(segments) and len(segments[s + 1][1]) and segments[s + 1][1][0] < fromTime:
+                continue # All before fromTime
+            try:
+                f = open(self._segmentPath(number), "rb")
+            except OSError:
+                continue # Rotated away since the query started
+            try:
+                for block in range(self._startBlock(firstTimes, fromTime), len(firstTimes)):
+                    if firstTimes[block] > toTime:
+                        return
+                    for t, ch, value in self._blockRecords(f, block, buf):
+                        if t > toTime:
+                            return
+                        if t >= fromTime and (channelId is None or ch == channelId) and ch < len(self.names):
+                            yield t, self.names[ch], value
+            except OSError as e:
+                logger.debug(const("SampleLog segment %d gone part way through a query: %s"), number, str(e))
+            finally:
+                f.close()
+
+    def _blockRecords(self, f, block, chunk):
+        # (time, channel id, value) of the good records in a block, a chunk at a time
+        f.seek(block * BLOCK)
+        for c in range(PER_BLOCK // _CHUNK):
+            n = f.readinto(chunk) // RECORD
+            for i in range(n):
+                t, value, ch, marker, check = struct.unpack_from(_FORMAT, chunk, i * RECORD)
+                if marker == _MARKER and check == _check(t, ch):
+                    yield t, ch, value
+            if n < _CHUNK:
+                break
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flushInterval)
+            self.flush()
@@ -13,15 +13,21 @@
         the superclass is initialised correctly
     3 - Provide your own _init() function which actually initialises the attached sensor. See the
         comments on the _init() function for instructions - basically, it implements a state machine,
-        and is called repeatedly by the main task, passing back the new state and any pause interval.
-        This last allows timed waits for the sensor to perform its initialisation, rather than dodgy
-        time.sleep() which halts everything!!
+        and is called once by the scheduler (sensors.SensorScheduler - one task runs every sensor),
+        with asyncio.sleep[_ms]() for any pauses. This last allows timed waits for the sensor to
+        perform its initialisation, rather than dodgy time.sleep() which halts everything!!
     4 - Provide your own _collectData() function to collect data from the sensor and store it in
         self.values, as per the example. Like _init(), it is a state machine and permits sensor trigger
         and any required wait for the correct sensor state before collecting data
     
+    Each numeric value is also kept in a history of the last historySize samples - see getHistory() -
+    and, given a sensors.SampleLog, logged to flash. Given rollupLevels (e.g. sensors.Rollup.LEVELS,
+    per minute/quarter hour/hour/day) the rollupChannels values (or all of them) are rolled up too -
+    see getRollup(); that's a few KB a value, so it's off unless asked for
+    
 """
 import asyncio, time
+from array import array
 from micropython import const
 
 import logging
@@ -30,19 +36,54 @@ logger = logging.getLogger(__name__)
 from ESPLogRecord import ESPLogRecord
 logger.record = ESPLogRecord()
 
+from Metrics import metrics
+from sensors.Rollup import Rollup
+from sensors.SensorScheduler import scheduler
+_collectMs = metrics.histogram("sensor_collect_duration_ms", "_collectData() time by sensor",
+                               (10, 25, 50, 100, 250, 500, 1000, 2500), ("sensor",))
+
+NAN = float("nan")
+
 class Sensor:
     """" Sensor: the base class for sensors
             Sensor(name = "name")
                 name: some name you might need to identify it
             
-            run(interval = 5)
-                interval: the interval in seconds between sensor scans
+            Sensor(interval = 5)
+                interval: the interval in seconds between sensor scans, kept to by the scheduler;
+                collections, overruns, errors, lateMs and lateMaxMs say how well
                 
             getValues()
                 returns a tuple of current values e.g. ("temp":25.6, "RH":55, "CO2":440)
+                
+            getValuesSince(seq)
+                returns just the values that have changed in samples after sequence number seq;
+                every sample any sensor collects gets the next number from Sensor.seq, and
+                sampleSeq/sampleTime are the number and time.time() of this sensor's latest
+                
+            getHistory(channel, n)
+                the last n (default all held) samples of a value as a list of (times, values)
+                memoryview pairs, oldest first - two of them when the ring buffer has wrapped.
+                Times are sampleTime secs; values are floats, or 16 bit ints for values that
+                have only ever been whole numbers from 0 to 65534 (e.g. CO2 ppm), with NaN/0xffff
+                where a sample didn't have the value. The views are onto the buffers themselves,
+                so use them before the next sample overwrites them
+                
+            getRollup(channel, resolution, n)
+                count, mean, min and max of a value for the last n buckets of resolution secs
+                (one of the rollupLevels), as (start time, count, mean, min, max) tuples, oldest
+                first; empty without rollups. See sensors.Rollup
+                
+            Sensor.newData
+                asyncio.Event shared by all sensors, set each time any of them has collected
+                new values, so consumers (e.g. the WebServer /events stream) can wait on it.
+                It only wakes those already waiting, so compare sampleSeq with the last one
+                seen before waiting, or a sample that came while busy is missed
     """
+    newData = asyncio.Event()
+    seq = 0		# Sequence number of the latest sample from any sensor
     
-    def __init__(self, interval = 5, name="Sensor"):
+    def __init__(self, interval = 5, name="Sensor", historySize=60, rollupLevels=None, rollupChannels=None, sampleLog=None):
         logger.debug(const("%s __init__"), self.__class__)
         '''
         try:
@@ -56,52 +97,99 @@ class Sensor:
         self.name = name
         self.values = {}			# This is what is returned by getValues()
         self.interval = interval	# Pause time between data collections
-        asyncio.create_task(self.taskToRun())
-        logger.debug(const("taskToRun taskToRun task created"))
+        self.sampleSeq = 0
+        self.sampleTime = 0
+        self.valueSeq = {}			# value name -> (seq of the sample that changed it, value)
+        # History: fixed size ring buffers, one per value, allocated when the value first turns up
+        self.historySize = historySize	# Samples kept; 0 for none
+        self.historyCount = 0			# Samples ever recorded; the next goes in historyCount % historySize
+        self.historyTimes = array('I', [0] * historySize)
+        self.history = {}				# value name -> [array, historyCount when it started, whole numbers?]
+        self.rollup = Rollup(rollupLevels, rollupChannels) if rollupLevels else None
+        self.sampleLog = sampleLog		# Can be shared by several sensors
+        # Kept up to date by the scheduler
+        self._ready = False
+        self.collections = 0
+        self.overruns = 0				# Deadlines missed because a collection ran over
+        self.errors = 0
+        self.lateMs = 0					# How late the last collection started
+        self.lateMaxMs = 0
+        scheduler.add(self)
+        logger.debug(const("added to the scheduler"))
 
-    def _getUsecStr(self, ns):
-        nsStr = str(ns)
-        return nsStr[:len(nsStr)-3]
-        
-    async def taskToRun(self):
+    async def collect(self):
         """
-            taskToRun
-                Uses two async tasks
-                _init() - takes what it takes to complete
-                _collectData() - likewise
+            collect
+                Called by the scheduler every interval: _collectData(), then number the sample,
+                keep it and tell everyone it's there
         """
-        logger.debug(const("taskToRun entered: interval: %d"), self.interval)
-        # Perform initialisation through _init task
-        start = time.time_ns()
-        task = asyncio.create_task(self._init())
-        logger.debug(const("taskToRun _init task created"))
-        result = await asyncio.wait_for(task, None)
-        logger.debug('taskToRun: _init execute %s us', self._getUsecStr(time.time_ns() - start))
-        if not result: # for the demo always True
-            logger.error('taskToRun: init error: %s', result)
-            return # give up
-        self._ready = True
-        # Get on with the data collection task...        
-        while True:
-            start = time.time_ns()
-            logger.debug(const("taskToRun executing"))
-            task = asyncio.create_task(self._collectData())
-            result = await asyncio.wait_for(task, None)
-            # Should do something with the result...
-            end = time.time_ns()
-            exec_ns = end - start
-            exec_ms = int(self._getUsecStr(exec_ns))/1000
-            logger.debug('taskToRun: _collectData execute %s us %d ms', self._getUsecStr(exec_ns), exec_ms)
-            # Restore the interval!
-            exec_ns = time.time_ns() - start
-            waitTime = (self.interval*1000) - (exec_ns/1000000)        
-            await asyncio.sleep_ms(int(waitTime))
+        start = time.ticks_ms()
+        result = self._collectData()
+        if hasattr(result, "send"): # A coroutine
+            result = await result
+        # Should do something with the result...
+        self._stamp()
+        self.publish()
+        self.collections += 1
+        exec_ms = time.ticks_diff(time.ticks_ms(), start)
+        logger.debug(const("collect: _collectData execute %d ms"), exec_ms)
+        _collectMs.observe(exec_ms, self.name)
+        metrics.sampleHeap()
+
+    def _stamp(self):
+        # Number the new sample, and note which values it changed
+        Sensor.seq += 1
+        self.sampleSeq = Sensor.seq
+        self.sampleTime = int(time.time()) # Whole secs - as MicroPython gives them anyway
+        for k, v in self.values.items():
+            last = self.valueSeq.get(k)
+            if last is None or last[1] != v:
+                self.valueSeq[k] = (self.sampleSeq, v)
+        if self.historySize:
+            self._record()
+        if self.rollup is not None:
+            self.rollup.add(self.sampleTime, self.values)
+        if self.sampleLog is not None:
+            self.sampleLog.add(self.sampleTime, self.values)
+
+    def _record(self):
+        # Add the sample to the history - no allocation once every value has its buffer
+        i = self.historyCount % self.historySize
+        self.historyTimes[i] = self.sampleTime
+        values = self.values
+        for k, h in self.history.items():
+            if not isinstance(values.get(k), (int, float)): # Not there, None, or a status string
+                h[0][i] = 0xffff if h[2] else NAN
+        for k, v in values.items():
+            if not isinstance(v, (int, float)):
+                continue # Status strings etc.
+            h = self.history.get(k)
+            if h is None:
+                # Whole numbers that fit go in 16 bits, anything else as a float
+                whole = isinstance(v, int) and 0 <= v < 0xffff
+                h = self.history[k] = [array('H' if whole else 'f', [0] * self.historySize), self.historyCount, whole]
+            if h[2]:
+                if isinstance(v, int) and 0 <= v < 0xffff:
+                    h[0][i] = v
+                    continue
+                # A fraction or out of range after all (a reading that started at e.g. 21): it's a
+                # float from now on, missing samples carried over as NaN
+                h[0] = array('f', [NAN if x == 0xffff else x for x in h[0]])
+                h[2] = False
+            h[0][i] = v
+        self.historyCount += 1
+
+    @classmethod
+    def publish(cls):
+        """ Wakes everything waiting on Sensor.newData """
+        cls.newData.set()
+        cls.newData.clear() # Waiters have already been woken
 
     async def _init(self):
         '''
             REPLACE WITH YOUR SubClass METHOD!! This is just demo code!!
             
-            _init - runs as a separate asyncio task, performs all init wait actions with asyncio.sleep[_ms]()
+            _init - awaited once by the scheduler, performs all init wait actions with asyncio.sleep[_ms]()
             
         '''
         demoInitPause = 100 # You need to get rid of these!
@@ -118,7 +206,7 @@ class Sensor:
             REPLACE WITH YOUR SubClass METHOD!!
 
             _collectData - collects data from the sensor
-                            Runs as a Task until complete from _taskToRun
+                            Awaited by collect() until complete
         """
         self.values = {"None":None}
         logger.debug(const("_collectData executing: State:%d : values: %s"), self.values)
@@ -128,6 +216,36 @@ class Sensor:
     def getValues(self):
         return self.values
 
+    def getHistory(self, channel, n=None):
+        h = self.history.get(channel)
+        if h is None:
+            return []
+        held = min(self.historyCount - h[1], self.historySize)
+        if n is None or n > held:
+            n = held
+        if n <= 0:
+            return []
+        times = memoryview(self.historyTimes)
+        values = memoryview(h[0])
+        start = (self.historyCount - n) % self.historySize
+        end = start + n
+        if end <= self.historySize:
+            return [(times[start:end], values[start:end])]
+        end -= self.historySize
+        return [(times[start:], values[start:]), (times[:end], values[:end])]
+
+    def getRollup(self, channel, resolution, n=None):
+        if self.rollup is None:
+            return []
+        return self.rollup.getRollup(channel, resolution, n)
+
+    def getValuesSince(self, seq):
+        changed = {}
+        for k, last in self.valueSeq.items():
+            if last[0] > seq:
+                changed[k] = last[1]
+        return changed
+
 class RandomSensor(Sensor):
 
     async def _collectData(self):
@@ -0,0 +1,113 @@
+"""
+    SensorScheduler
+    One task that runs every Sensor: _init() once, then collect() every interval secs,
+    in deadline order from a heap - rather than a task per sensor, and a new task per
+    collection.
+
+    Deadlines are kept on an unwrapped time.ticks_ms() clock and each is the previous
+    one plus the interval, so sampling stays phase-locked however long collections
+    take. One that runs past its next deadline skips the deadlines it missed (counted
+    as overruns) rather than catching up in a burst. How late each collection starts
+    is the sensor's jitter: lateMs/lateMaxMs on the sensor, and a histogram in /metrics.
+
+    Collections run one at a time in this task, so a _collectData() that awaits a long
+    conversion holds up the others - keep the waits short.
+
+    scheduler.add(sensor)
+        The Sensor base class does this; the task starts with the first one
+    scheduler.getStats()
+        {sensor name: {"collections", "overruns", "errors", "lateMs", "lateMaxMs"}}
+"""
+import asyncio, time, heapq
+from micropython import const
+
+import logging
+
+logger = logging.getLogger(__name__)
+from ESPLogRecord import ESPLogRecord
+logger.record = ESPLogRecord()
+
+from Metrics import metrics
+_lateMs = metrics.histogram("sensor_start_late_ms", "How late collections start against their deadline",
+                            (1, 5, 10, 25, 50, 100, 250, 1000), ("sensor",))
+_overruns = metrics.counter("sensor_overruns_total", "Deadlines missed because a collection ran over", ("sensor",))
+_errors = metrics.counter("sensor_errors_total", "_init()/_collectData() exceptions", ("sensor",))
+
+class SensorScheduler:
+
+    def __init__(self, maxSleep=1000):
+        self.heap = []			# (deadline ms, order added, sensor) - order so sensors are never compared
+        self.added = 0
+        self.sensors = []
+        self.maxSleep = maxSleep	# ms - sensors added while it's asleep wait at most this long
+        self.ticks = time.ticks_ms()
+        self.now = 0			# ms since the scheduler was made, unwrapped from ticks_ms()
+        self.task = None
+
+    def _clock(self):
+        t = time.ticks_ms()
+        self.now += time.ticks_diff(t, self.ticks)
+        self.ticks = t
+        return self.now
+
+    def add(self, sensor):
+        heapq.heappush(self.heap, (self._clock(), self.added, sensor))
+        self.added += 1
+        self.sensors.append(sensor)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def getStats(self):
+        return {s.name: {"collections": s.collections, "overruns": s.overruns, "errors": s.errors,
+                         "lateMs": s.lateMs, "lateMaxMs": s.lateMaxMs} for s in self.sensors}
+
+    async def run(self):
+        while True:
+            now = self._clock()
+            if not self.heap or self.heap[0][0] > now:
+                await asyncio.sleep_ms(min(self.heap[0][0] - now, self.maxSleep) if self.heap else self.maxSleep)
+                continue
+            deadline, order, sensor = heapq.heappop(self.heap)
+            if not sensor._ready:
+                if await self._init(sensor):
+                    heapq.heappush(self.heap, (self._clock(), order, sensor)) # First collection straight away
+                continue
+            late = now - deadline
+            sensor.lateMs = late
+            if late > sensor.lateMaxMs:
+                sensor.lateMaxMs = late
+            _lateMs.observe(late, sensor.name)
+            try:
+                await sensor.collect()
+            except Exception as e:
+                sensor.errors += 1
+                _errors.inc(sensor.name)
+                logger.error(const("%s _collectData failed: %s"), sensor.name, str(e))
+            interval = int(sensor.interval * 1000)
+            deadline += interval
+            now = self._clock()
+            if now > deadline: # Only late, not just on time, is an overrun
+                missed = (now - deadline - 1) // interval + 1 # Up to the first deadline not yet past
+                deadline += missed * interval
+                sensor.overruns += missed
+                _overruns.inc(sensor.name, n=missed)
+            heapq.heappush(self.heap, (deadline, order, sensor))
+
+    async def _init(self, sensor):
+        start = time.ticks_ms()
+        try:
+            result = await sensor._init()
+        except Exception as e:
+            logger.error(const("%s _init failed: %s"), sensor.name, str(e))
+            result = False
+        if not result:
+            sensor.errors += 1
+            _errors.inc(sensor.name)
+            logger.error(const("%s init error: %s - not collecting from it"), sensor.name, result)
+            self.sensors.remove(sensor)
+            return False
+        logger.debug(const("%s _init took %d ms"), sensor.name, time.ticks_diff(time.ticks_ms(), start))
+        sensor._ready = True
+        return True
+
+scheduler = SensorScheduler()
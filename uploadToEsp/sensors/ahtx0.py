@@ -26,8 +26,14 @@ MicroPython driver for the AHT10 and AHT20 Humidity and Temperature Sensor
 
 Author(s): Andreas Bühl, Kattni Rembor
 
+await measure() triggers one conversion, awaits it with asyncio.sleep_ms() rather than
+blocking, and returns (temperature, relative humidity) decoded from the same reading.
+The temperature and relative_humidity properties still work, but each does its own
+blocking conversion - use them only outside the event loop.
+
 """
 
+import asyncio
 import utime
 from micropython import const
 import logging
@@ -46,6 +52,7 @@ class AHT10:
     AHTX0_CMD_SOFTRESET = const(0xBA)  # Soft reset command
     AHTX0_STATUS_BUSY = const(0x80)  # Status bit for busy
     AHTX0_STATUS_CALIBRATED = const(0x08)  # Status bit for calibrated
+    AHTX0_MEASUREMENT_MS = const(80)  # Conversion time from the datasheet
 
     def __init__(self, i2c, address=AHTX0_I2CADDR_DEFAULT):
         logger.info(const("initialising: address: 0x%x"), address)
@@ -89,10 +96,7 @@ class AHT10:
         """The measured relative humidity in percent."""
         logger.debug(const("RH"))
         self._perform_measurement()
-        self._humidity = (
-            (self._buf[1] << 12) | (self._buf[2] << 4) | (self._buf[3] >> 4)
-        )
-        self._humidity = (self._humidity * 100) / 0x100000
+        self._decode()
         return self._humidity
 
     @property
@@ -100,10 +104,28 @@ class AHT10:
         """The measured temperature in degrees Celcius."""
         logger.debug(const("temperature"))
         self._perform_measurement()
-        self._temp = ((self._buf[3] & 0xF) << 16) | (self._buf[4] << 8) | self._buf[5]
-        self._temp = ((self._temp * 200.0) / 0x100000) - 50
+        self._decode()
         return self._temp
 
+    async def measure(self):
+        """One measurement, without blocking: returns (temperature, relative humidity)"""
+        logger.debug(const("measure"))
+        self._trigger_measurement()
+        await asyncio.sleep_ms(self.AHTX0_MEASUREMENT_MS)
+        self._read_to_buffer()
+        while self._buf[0] & self.AHTX0_STATUS_BUSY:
+            await asyncio.sleep_ms(5)
+            self._read_to_buffer()
+        self._decode()
+        return self._temp, self._humidity
+
+    def _decode(self):
+        """Temperature and humidity from the 6 bytes of a reading in the buffer"""
+        humidity = (self._buf[1] << 12) | (self._buf[2] << 4) | (self._buf[3] >> 4)
+        self._humidity = (humidity * 100) / 0x100000
+        temp = ((self._buf[3] & 0xF) << 16) | (self._buf[4] << 8) | self._buf[5]
+        self._temp = ((temp * 200.0) / 0x100000) - 50
+
     def _read_to_buffer(self):
         """Read sensor data to buffer"""
         self._i2c.readfrom_into(self._address, self._buf)
@@ -12,9 +12,15 @@ from sensors.Sensor import Sensor
 from sensors.ens160 import ENS160
 from sensors.ahtx0 import AHT20  # Assuming AHT20 is compatible with AHT21 and supported by ahtx0 library
 
+# Rollups of the readings only (not Validity, AQI or the ENS160's compensation values) by quarter
+# hour for a day and by day for a fortnight - the history already has the last hour - ~6 KB
+ROLLUP_LEVELS = ((900, 96), (86400, 14))
+ROLLUP_CHANNELS = ("AHT_Temp", "AHT_RH", "CO2", "TVOC")
+
 class ENS160AHT21(Sensor):
 
-    def __init__( self, i2c=1, sclPin=25, sdaPin=26,freq=100000, interval = 30, name = "ENS160AHT21"):
+    def __init__( self, i2c=1, sclPin=25, sdaPin=26,freq=100000, interval = 30, name = "ENS160AHT21", historySize=120, sampleLog=None,
+                  rollupLevels=ROLLUP_LEVELS, rollupChannels=ROLLUP_CHANNELS):
         #print(type(i2c),type(sclPin),type(sdaPin),type(freq))
         logger.info(const("initialising ENS160AHT21: I2CUnit: %d SCL: %d SDA: %d freq: %d"), i2c, sclPin, sdaPin, freq)
         self.temperature_offset = -10.0  # Adjust this value as needed - no idea why we might!
@@ -29,7 +35,8 @@ class ENS160AHT21(Sensor):
                          e, i2c, self.sclPin, self.sdaPin)
             raise e
         # Need to do this after all init completed!
-        super().__init__(interval=interval, name=name)
+        super().__init__(interval=interval, name=name, historySize=historySize, # An hour at 30 secs
+                         rollupLevels=rollupLevels, rollupChannels=rollupChannels, sampleLog=sampleLog)
 
     async def _init(self):
         # Initialize the ENS160 sensor
@@ -44,8 +51,8 @@ class ENS160AHT21(Sensor):
     # SubClass data collection function implementation
     async def _collectData(self):
         logger.debug(const("_collectData from ENS160ATH21"))
-        temp_aht21 = self.sensor_aht21.temperature
-        rh_aht21 = self.sensor_aht21.relative_humidity
+        # One conversion for both, awaited rather than blocking everything else
+        temp_aht21, rh_aht21 = await self.sensor_aht21.measure()
         self.values['AHT_Temp'] = round(temp_aht21,1)
         self.values['AHT_RH'] = round(rh_aht21,1)
         self.sensor_ens160.set_envdata(temp_aht21,rh_aht21)
@@ -58,7 +65,6 @@ class ENS160AHT21(Sensor):
         self.values['ENS_RH'] = round(rh, 1)
         self.values['ECO2_Rating'] = eco2_rating
         self.values['TVOC_Rating'] = tvoc_rating
-        # Read temperature and humidity from AHT21
         logger.debug(const("Values: %s"), self.values)
         return True # All done
         
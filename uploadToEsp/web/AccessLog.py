@@ -0,0 +1,116 @@
+"""
+    AccessLog
+    Fixed-size ring buffer of what the WebServer has served - time, client, route,
+    status, bytes and duration - kept as numbers in preallocated arrays, so logging a
+    request does no string formatting and no UART output. Text is only made when
+    someone asks for it (/accesslog), or by the optional flush to flash.
+
+    __init__
+        size - records kept; the oldest are overwritten
+        path - if given, run() appends new records to this file every flushInterval
+            secs, moving it to path + ".1" once it's bigger than maxFileSize
+
+    add(peer, method, route, status, nbytes, ms)
+        Called once per request. Routes are numbered the first time they're seen,
+        peer is kept as the address object the socket gave us; status 0 is an event
+        stream or WebSocket that had the connection
+    lines(n, since)
+        Records formatted, oldest first: the last n, or those from record number since
+    run()
+        Flush loop - start it as a task if there's a path
+"""
+import asyncio, time, os
+import logging
+from array import array
+from micropython import const
+
+logger = logging.getLogger(__name__)
+from ESPLogRecord import ESPLogRecord
+logger.record = ESPLogRecord()
+
+class AccessLog:
+
+    def __init__(self, size=64, path=None, flushInterval=60, maxFileSize=32768):
+        self.size = size
+        self.path = path
+        self.flushInterval = flushInterval
+        self.maxFileSize = maxFileSize
+        self.times = array('I', [0] * size)		# time.time() secs
+        self.statuses = array('H', [0] * size)
+        self.nbytes = array('I', [0] * size)
+        self.durations = array('H', [0] * size)	# ms, capped at 65535
+        self.routeIds = array('B', [0] * size)
+        self.peers = [None] * size
+        self.routes = []		# route id -> (method, route)
+        self.routeIndex = {}	# (method, route) -> route id
+        self.count = 0			# Records ever added; the next goes in count % size
+        self.flushed = 0		# Records written to the file so far
+        self.dropped = 0		# Records overwritten before they could be flushed
+
+    def _routeId(self, method, route):
+        key = (method, route)
+        routeId = self.routeIndex.get(key)
+        if routeId is None:
+            if len(self.routes) >= 255:
+                key = (method, "other")	# Patterns are few, this is just a backstop
+                routeId = self.routeIndex.get(key)
+            if routeId is None:
+                routeId = self.routeIndex[key] = len(self.routes)
+                self.routes.append(key)
+        return routeId
+
+    def add(self, peer, method, route, status, nbytes, ms):
+        i = self.count % self.size
+        self.times[i] = int(time.time())
+        self.peers[i] = peer
+        self.routeIds[i] = self._routeId(method, route)
+        self.statuses[i] = status
+        self.nbytes[i] = nbytes
+        self.durations[i] = ms if ms < 0xffff else 0xffff
+        self.count += 1
+
+    def _format(self, i):
+        t = time.localtime(self.times[i])
+        method, route = self.routes[self.routeIds[i]]
+        return "%04d-%02d-%02d %02d:%02d:%02d %s %s %s %d %d %d\n" % (
+            t[0], t[1], t[2], t[3], t[4], t[5], self.peers[i], method, route,
+            self.statuses[i], self.nbytes[i], self.durations[i])
+
+    def lines(self, n=None, since=0):
+        """ Formatted records from number since (or the oldest still held), at most the last n """
+        first = max(since, self.count - self.size)
+        if n is not None:
+            first = max(first, self.count - n)
+        return [self._format(k % self.size) for k in range(first, self.count)]
+
+    def flush(self):
+        if self.count - self.flushed > self.size:
+            self.dropped += self.count - self.flushed - self.size
+            self.flushed = self.count - self.size
+        lines = self.lines(since=self.flushed)
+        if not lines:
+            return
+        try:
+            try:
+                if os.stat(self.path)[6] > self.maxFileSize:
+                    try:
+                        os.remove(self.path + ".1")
+                    except OSError:
+                        pass
+                    os.rename(self.path, self.path + ".1")
+            except OSError:
+                pass # Not there yet
+            with open(self.path, "a") as f:
+                for line in lines:
+                    f.write(line)
+            self.flushed = self.count
+        except OSError as e:
+            logger.warning(const("Couldn't write access log %s: %s"), self.path, str(e))
+
+    def getStats(self):
+        return {"logged": self.count, "flushed": self.flushed, "dropped": self.dropped}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flushInterval)
+            self.flush()
@@ -0,0 +1,154 @@
+"""
+    DocIndex
+    In-memory index of the files under the web docroot, so serving a static file
+    doesn't need a flash directory scan and stat every time.
+
+    __init__
+        Scans the docroot (and any sub-directories) once
+
+    lookup
+        Returns the DocEntry for a URL path e.g. "/index.html", or None; the entry
+        provides the file's ETag and Last-Modified validators, and the header lines
+        carrying them ready encoded for the ResponseBuilder
+
+    invalidate
+        Call when files have been added/changed/removed at run time: with a URL path
+        just that file (and its .gz) is re-checked, with no path the docroot is rescanned
+
+"""
+import os
+import time
+import logging
+from micropython import const
+
+logger = logging.getLogger(__name__)
+from ESPLogRecord import ESPLogRecord
+logger.record = ESPLogRecord()
+
+from web.ResponseBuilder import fileToContentType
+
+_days = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_months = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+def httpDate(secs):
+    """ e.g. "Sun, 06 Nov 1994 08:49:37 GMT" """
+    t = time.gmtime(secs)
+    return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (_days[t[6]], t[2], _months[t[1] - 1], t[0], t[3], t[4], t[5])
+
+class DocEntry:
+    # size is -1 if there is only a .gz version; gzSize is 0 if there isn't one
+    def __init__(self, size, mtime, content_type, maxAge, gzSize):
+        self.size = size
+        self.mtime = mtime
+        self.content_type = content_type
+        self.maxAge = maxAge
+        self.gzSize = gzSize
+        self._lastModified = None
+        self._headers = [None, None]	# validators() for the plain and gzipped versions
+
+    def etag(self, gzip=False):
+        # Strong validator from size+mtime; the gzipped version is a different representation
+        if gzip:
+            return '"%x-%x-gz"' % (self.mtime, self.gzSize)
+        return '"%x-%x"' % (self.mtime, self.size)
+
+    def lastModified(self):
+        if self._lastModified is None:
+            self._lastModified = httpDate(self.mtime)
+        return self._lastModified
+
+    def validators(self, gzip=False):
+        """ ETag, Last-Modified, Cache-Control, Vary and Accept-Ranges header lines as bytes, built once """
+        i = 1 if gzip else 0
+        if self._headers[i] is None:
+            h = "ETag: " + self.etag(gzip) + "\r\nLast-Modified: " + self.lastModified() + "\r\n"
+            if self.maxAge > 0:
+                h += "Cache-Control: max-age=%d\r\n" % self.maxAge
+            elif self.maxAge == 0:
+                h += "Cache-Control: no-cache\r\n"
+            if self.gzSize > 0: # Caches need to know the content depends on Accept-Encoding
+                h += "Vary: Accept-Encoding\r\n"
+            if self.size >= 0: # Ranges are served from the uncompressed file
+                h += "Accept-Ranges: bytes\r\n"
+            self._headers[i] = h.encode()
+        return self._headers[i]
+
+    def changed(self):
+        self._lastModified = None
+        self._headers = [None, None]
+
+def contentTypeFor(filename):
+    """ Returns (content type, Cache-Control max-age) """
+    parts = filename.rsplit(".", 1)
+    if len(parts) == 2 and parts[1] in fileToContentType:
+        return fileToContentType[parts[1]]
+    return fileToContentType['unknown']
+
+class DocIndex:
+
+    def __init__(self, docroot="/"):
+        if docroot[0] != "/":
+            docroot = "/" + docroot
+        self.docroot = docroot.rstrip("/")
+        self.files = {}
+        self.invalidate()
+
+    def lookup(self, path):
+        return self.files.get(path)
+
+    def fullPath(self, path):
+        return self.docroot + path
+
+    def invalidate(self, path=None):
+        if path is None:
+            self.files = {}
+            self._scan(self.docroot, "")
+            logger.info(const("Indexed %d files in %s"), len(self.files), self.docroot)
+        else:
+            if path.endswith(".gz"):
+                path = path[:-3]
+            if path in self.files:
+                del self.files[path]
+            self._add(path, self._stat(path))
+            self._add(path + ".gz", self._stat(path + ".gz"))
+
+    def _stat(self, path):
+        try:
+            return os.stat(self.docroot + path)
+        except OSError:
+            return None
+
+    def _scan(self, dirPath, urlPrefix):
+        try:
+            names = os.listdir(dirPath)
+        except OSError as e:
+            logger.warning("Can't list docroot %s: %s", dirPath, e)
+            return
+        for name in names:
+            st = os.stat(dirPath + "/" + name)
+            if st[0] & 0x4000: # Directory
+                self._scan(dirPath + "/" + name, urlPrefix + "/" + name)
+            else:
+                self._add(urlPrefix + "/" + name, st)
+
+    def _add(self, path, st):
+        if st is None:
+            return
+        if path.endswith(".gz"):
+            path = path[:-3]
+            entry = self.files.get(path)
+            if entry is None:
+                content_type, maxAge = contentTypeFor(path)
+                self.files[path] = DocEntry(-1, st[8], content_type, maxAge, st[6])
+            else:
+                entry.gzSize = st[6]
+                entry.changed()
+        else:
+            entry = self.files.get(path)
+            if entry is None:
+                content_type, maxAge = contentTypeFor(path)
+                self.files[path] = DocEntry(st[6], st[8], content_type, maxAge, 0)
+            else: # Found the .gz first
+                entry.size = st[6]
+                entry.mtime = st[8]
+                entry.changed()
@@ -1,145 +1,403 @@
 # Request object to handle http requests
+#
+# Requests are read from the StreamReader a chunk at a time into a bytearray that is
+# reused for every request on the connection. Lines are parsed as they arrive, header
+# names/values are only recorded as offsets into the buffer and decoded when asked for,
+# and the body is read strictly by Content-Length. Any bytes following the body belong
+# to the next (pipelined) request and are kept for the next read().
+#
+# read() can be given timeouts for each part of a request: waiting for it to start,
+# getting the rest of the headers and getting the body. A client that runs out of time
+# part way through gets a 408, as does one that takes longer than requestTimeout over the
+# headers and body together. The wait for a request to start can also be given up early,
+# when the server would rather have the connection's slot back.
 import re
 import json
+import time
+import asyncio
 import logging
+from array import array
+
+from web.url_decode import url_decode
 
 logger = logging.getLogger(__name__)
 from ESPLogRecord import ESPLogRecord
 logger.record = ESPLogRecord()
 
+_IDLE_POLL = 0.5	# Secs between giveUp() checks while idle
+
+def _within(coro, timeout):
+    return asyncio.wait_for(coro, timeout) if timeout else coro
 
 class RequestParser:
 
-    def __init__(self, raw_request):
-        # make sure raw_request is a str
-        # Stream object returns bytes; memoryview is bytearray, but that doesn't work!
-        if isinstance(raw_request, bytes) or isinstance(raw_request, bytearray):
-            logger.debug("raw_request decode reqd: %s", type(raw_request))
-            raw_request = raw_request.decode("utf-8")
+    BUFFER_SIZE = 2048		# Request line + headers must fit in here
+    MAX_HEADERS = 32		# Any more are ignored
+    MAX_BODY_SIZE = 8192	# Larger bodies are refused with 413
+
+    def __init__(self, raw_request=None, bufferSize=BUFFER_SIZE, maxBodySize=MAX_BODY_SIZE):
+        # raw_request lets a complete request held in memory be parsed without a stream
+        if isinstance(raw_request, str):
+            raw_request = raw_request.encode("utf-8")
+        if raw_request and len(raw_request) > bufferSize:
+            bufferSize = len(raw_request)
+        self._buf = bytearray(bufferSize)
+        self._mv = memoryview(self._buf)
+        self._hdrs = array('H', [0] * (4 * self.MAX_HEADERS)) # name start/end, value start/end
+        self._readinto = None	# Does the stream support readinto()? Set on first read
+        self.maxBodySize = maxBodySize
+        self._start = 0			# Start of the current request in the buffer
+        self._end = 0			# End of the data read so far
+        # The connection the requests arrive on, set by the WebServer for handlers that need it
+        self.reader = None
+        self.writer = None
+        self.peerInfo = ()
+        self._reset()
+
+        if raw_request:
+            self._buf[0:len(raw_request)] = raw_request
+            self._end = len(raw_request)
+            if self._parse_lines():
+                self._parse_body_available()
+
+    def _reset(self):
         self.method = ""
         self.full_url = ""
         self.url = ""
         self.query_string = ""
         self.protocol = ""
-        self.headers = {}
         self.query_params = {}
         self.post_data = {}
         self.boundary = False
         self.content = []
+        self.body = None
+        self.error = 0			# HTTP status if the request couldn't be read properly
+        self.timedOut = None	# "idle", "header" or "body" if read() ran out of time there
+        self.started = 0		# ticks_ms() when the first byte of the request arrived
+        self._hdrCount = 0
+        self._hdrCache = {}
+        self._scan = self._start	# Where to look for the next LF
+        self._lineStart = self._start
+        self._bodyStart = 0
 
-        self.parse_request(raw_request)
-
-    def parse_request(self, raw_request):
-
-        if len(raw_request) > 0:
-            # some data supplied
-            # check end of line chars
-            eol_char = '\r\n'  # default as per HTTP protocol
-            if raw_request.find('\r\n') == -1:
-                # some systems may use single char newline
-                eol_char = '\n'
-            # split request into individual lines
-            request_lines = raw_request.split(eol_char)
-
-            # first line holds request verb, url and protocol
-            self.parse_first_line(request_lines[0])
-
-            if len(request_lines) > 1:
-                # next section holds header information - section ends with blank line
-                # parse header lines
-                line_num = 1  # skip first line
-                while line_num < len(request_lines) and len(request_lines[line_num]) != 0:
-                    header, value = self.parse_header_line(request_lines[line_num])
-                    if header:
-                        self.headers[header] = value
-                    line_num += 1
-
-                # check if any lines left for content
-                # headers must be followed by blank line, then content lines
-                line_num += 1  # skip blank line (if there)
-                if line_num > (len(request_lines) - 1):
-                    # no lines left
-                    return
+    async def read(self, reader, idleTimeout=None, headerTimeout=None, bodyTimeout=None, giveUp=None,
+                   requestTimeout=None):
+        """
+            Reads the next request from the stream, allowing the client idleTimeout secs to
+            start sending it, then headerTimeout for the rest of the headers and bodyTimeout
+            for the body (None for no limit), but no more than requestTimeout secs from its
+            start for both. If there's a giveUp function, it's asked every
+            half second while waiting for the request to start, and True ends the wait as if
+            idleTimeout had run out
+            Returns False if the client closed the connection (or stayed idle) before sending one
+        """
+        # Shuffle any pipelined data down to the start of the buffer
+        leftover = self._end - self._start
+        if self._start > 0:
+            if leftover > 0:
+                self._buf[0:leftover] = bytes(self._mv[self._start:self._end])
+            self._start = 0
+            self._end = leftover
+        self._reset()
 
-                # content is any remaining lines
-                self.content = request_lines[line_num:]
-
-                # handle content depending on Content-Type header
-                content_type = self.get_header_value('Content-Type')
-                if content_type:
-                    # filter out form submissions
-                    if content_type.find('multipart/form-data') != -1:
-                        # data is in multipart/form-data format
-                        # get boundary string
-                        content_type_parts = content_type.split('boundary=')
-                        if len(content_type_parts) == 2:
-                            # found boundary
-                            self.boundary = content_type_parts[1]
-                        else:
-                            # boundary not found - error
-                            self.boundary = False
-                            return
-                        self.parse_content_form_data()
-
-                    elif content_type.find('application/x-www-form-urlencoded') != -1:
-                        # data is in application/x-www-form-urlencoded format
-                        self.parse_content_form_url_encoded()
-
-                    elif content_type.find('application/json') != -1 \
-                            or content_type.find('application/javascript') != -1:
-                        # data is in application/json format
-                        self.parse_json_body()
-
-                    else:
-                        # treat as text
-                        # leave content lines as list
-                        pass
-                else:
-                    # no content type - ignore
-                    pass
+        phase = "idle"
+        try:
+            if self._end == 0 and await self._idle(reader, idleTimeout, giveUp) == 0:
+                return False # Client went away
+            self.started = time.ticks_ms()
+            phase = "header"
+            if not await _within(self._read_headers(reader), self._left(headerTimeout, requestTimeout)):
+                return False
+            if self.error:
+                return True
+            contentLen = self.content_length()
+            if contentLen < 0:
+                self.error = 400
+                return True
+            if contentLen > self.maxBodySize:
+                logger.warning("Request body %d bytes, max %d", contentLen, self.maxBodySize)
+                self.error = 413
+                return True
+            phase = "body"
+            if not await _within(self._read_body(reader, contentLen), self._left(bodyTimeout, requestTimeout)):
+                return False
+        except asyncio.TimeoutError:
+            self.timedOut = phase
+            self._start = self._end = 0 # Whatever did arrive is no use now
+            if phase == "idle":
+                return False
+            logger.debug("Timed out reading request %s", phase)
+            self.error = 408
+            return True
+        self._parse_body_available()
+        return True
 
+    def _left(self, timeout, requestTimeout):
+        # The phase's timeout, cut to what's left of requestTimeout since the request started
+        if not requestTimeout:
+            return timeout
+        left = requestTimeout - time.ticks_diff(time.ticks_ms(), self.started) / 1000
+        if left <= 0:
+            raise asyncio.TimeoutError()
+        return left if not timeout or left < timeout else timeout
+
+    async def _idle(self, reader, idleTimeout, giveUp):
+        # Waits for the start of a request, a slice at a time if there's a giveUp to ask
+        if giveUp is None:
+            return await _within(self._fill(reader), idleTimeout)
+        waited = 0
+        while True:
+            wait = _IDLE_POLL if not idleTimeout else min(_IDLE_POLL, idleTimeout - waited)
+            try:
+                return await asyncio.wait_for(self._fill(reader), wait)
+            except asyncio.TimeoutError:
+                waited += wait
+                if giveUp() or (idleTimeout and waited >= idleTimeout):
+                    raise
+
+    async def _read_headers(self, reader):
+        # True once the headers are all in (or there's no room for them), False if the client went away
+        while not self._parse_lines():
+            if self._end == len(self._buf):
+                logger.warning("Request headers larger than %d bytes", len(self._buf))
+                self.error = 431
+                return True
+            if await self._fill(reader) == 0:
+                # Client went away; only complain if it was half way through a request
+                if self._end > self._start:
+                    logger.debug("Connection closed mid-request")
+                self._start = self._end = 0
+                return False
+        return True
+
+    async def _read_body(self, reader, contentLen):
+        # True once the body is in, False if the client went away
+        bodyEnd = self._bodyStart + contentLen
+        if bodyEnd <= len(self._buf):
+            # Body fits after the headers
+            while self._end < bodyEnd:
+                if await self._fill(reader) == 0:
+                    self._start = self._end = 0
+                    return False
         else:
+            # Too big for the buffer; it gets a buffer of its own, and the rest comes straight in
+            body = bytearray(contentLen)
+            have = self._end - self._bodyStart
+            body[0:have] = self._mv[self._bodyStart:self._end]
+            bodyMv = memoryview(body)
+            while have < contentLen:
+                n = await self._readinto_mv(reader, bodyMv[have:])
+                if n == 0:
+                    self._start = self._end = 0
+                    return False
+                have += n
+            self.body = bodyMv
+            self._start = self._end = self._bodyStart # Nothing left over for the next request
+        return True
+
+    async def _fill(self, reader):
+        n = await self._readinto_mv(reader, self._mv[self._end:])
+        self._end += n
+        return n
+
+    async def _readinto_mv(self, reader, mv):
+        # MicroPython streams can read straight into our buffer, CPython's can't
+        if self._readinto is None:
+            self._readinto = hasattr(reader, "readinto")
+        if self._readinto:
+            n = None
+            while n is None: # None just means no data yet
+                n = await reader.readinto(mv)
+            return n
+        data = await reader.read(len(mv))
+        n = len(data)
+        mv[0:n] = data
+        return n
+
+    def _parse_lines(self):
+        # Processes the complete lines in the buffer
+        # Returns True once the blank line ending the headers has been found
+        buf = self._buf
+        end = self._end
+        i = self._scan
+        while True:
+            while i < end and buf[i] != 10: # Look for LF
+                i += 1
+            if i >= end:
+                self._scan = i
+                return False
+            lineStart = self._lineStart
+            lineEnd = i
+            if lineEnd > lineStart and buf[lineEnd - 1] == 13: # Strip CR
+                lineEnd -= 1
+            i += 1
+            self._scan = self._lineStart = i
+            if not self.method:
+                if lineEnd > lineStart: # Skip any blank lines before the request line
+                    self.parse_first_line(lineStart, lineEnd)
+            elif lineEnd == lineStart:
+                self._bodyStart = i
+                return True
+            else:
+                self.parse_header_line(lineStart, lineEnd)
+
+    def _parse_body_available(self):
+        # Sets up self.body from the buffer if it isn't already separate, and the request
+        # start for anything pipelined after it, then handles the content by Content-Type
+        if self.body is None:
+            contentLen = self.content_length()
+            if contentLen < 0:
+                contentLen = 0
+            bodyEnd = min(self._bodyStart + contentLen, self._end)
+            self.body = self._mv[self._bodyStart:bodyEnd]
+            self._start = bodyEnd
+        if len(self.body) == 0:
             return
 
+        # handle content depending on Content-Type header
+        content_type = self.get_header_value('Content-Type')
+        if content_type:
+            # filter out form submissions
+            if content_type.find('multipart/form-data') != -1:
+                # data is in multipart/form-data format
+                # get boundary string
+                content_type_parts = content_type.split('boundary=')
+                if len(content_type_parts) == 2:
+                    # found boundary
+                    self.boundary = content_type_parts[1]
+                else:
+                    # boundary not found - error
+                    self.boundary = False
+                    return
+                self.content = self.body_text().split('\n')
+                for i in range(len(self.content)):
+                    if self.content[i].endswith('\r'):
+                        self.content[i] = self.content[i][:-1]
+                self.parse_content_form_data()
+
+            elif content_type.find('application/x-www-form-urlencoded') != -1:
+                # data is in application/x-www-form-urlencoded format
+                self.parse_content_form_url_encoded()
+
+            elif content_type.find('application/json') != -1 \
+                    or content_type.find('application/javascript') != -1:
+                # data is in application/json format
+                self.parse_json_body()
+
+            else:
+                # treat as text
+                # leave content in self.body
+                pass
+        else:
+            # no content type - ignore
+            pass
+
+    def body_text(self):
+        return bytes(self.body).decode("utf-8")
+
+    def content_length(self):
+        # -1 if the header is there but rubbish
+        value = self.get_header_value('Content-Length')
+        if not value:
+            return 0
+        try:
+            return int(value)
+        except ValueError:
+            return -1
+
+    def _find_header(self, header_name):
+        # Case-insensitive search of the recorded header names; returns the offsets index or -1
+        name = header_name.lower().encode()
+        nameLen = len(name)
+        buf = self._buf
+        h = self._hdrs
+        for i in range(0, self._hdrCount * 4, 4):
+            start = h[i]
+            if h[i + 1] - start != nameLen:
+                continue
+            j = 0
+            while j < nameLen and (buf[start + j] | 0x20) == name[j]:
+                j += 1
+            if j == nameLen:
+                return i
+        return -1
+
     def get_header_value(self, header_name):
-        if header_name in self.headers:
-            return self.headers[header_name]
+        if header_name in self._hdrCache:
+            return self._hdrCache[header_name]
+        i = self._find_header(header_name)
+        if i < 0:
+            value = False
         else:
-            return False
+            value = bytes(self._mv[self._hdrs[i + 2]:self._hdrs[i + 3]]).decode("utf-8")
+        self._hdrCache[header_name] = value
+        return value
+
+    @property
+    def headers(self):
+        # Decodes the lot - handy for debugging, but use get_header_value() for real work
+        h = self._hdrs
+        headers = {}
+        for i in range(0, self._hdrCount * 4, 4):
+            name = bytes(self._mv[h[i]:h[i + 1]]).decode("utf-8")
+            headers[name] = bytes(self._mv[h[i + 2]:h[i + 3]]).decode("utf-8")
+        return headers
 
-    def parse_first_line(self, first_line):
-        # split line on spaces to get words
-        line_parts = first_line.split()
+    def parse_first_line(self, start, end):
+        # request line is <method> SP <url> SP <protocol>
+        buf = self._buf
+        sp1 = start
+        while sp1 < end and buf[sp1] != 32:
+            sp1 += 1
+        sp2 = end - 1
+        while sp2 > sp1 and buf[sp2] != 32:
+            sp2 -= 1
         # should be three parts
-        if len(line_parts) == 3:
-            self.method = line_parts[0]
-            self.full_url = line_parts[1]
-            # try to split the full_url
-            url_parts = line_parts[1].split('?', 1)
-            self.url = url_parts[0]
-            # is there a query string?
-            if len(url_parts) > 1:
-                self.query_string = url_parts[1]
-            self.protocol = line_parts[2]
-            # decode query string if it's there
-            if len(self.query_string) > 0:
-                self.query_params = self.decode_query_string(self.query_string)
-        else:
+        if sp1 >= end or sp2 <= sp1 + 1:
             # something is wrong - flag it
             self.method = "ERROR"
+            self.error = 400
+            return
+        mv = self._mv
+        self.method = bytes(mv[start:sp1]).decode("utf-8")
+        self.full_url = bytes(mv[sp1 + 1:sp2]).decode("utf-8")
+        self.protocol = bytes(mv[sp2 + 1:end]).decode("utf-8")
+        # try to split the full_url
+        url_parts = self.full_url.split('?', 1)
+        self.url = url_parts[0]
+        # is there a query string?
+        if len(url_parts) > 1:
+            self.query_string = url_parts[1]
+        # decode query string if it's there
+        if len(self.query_string) > 0:
+            self.query_params = self.decode_query_string(self.query_string)
 
-    def parse_header_line(self, header_line):
-        # split header line on : to get name and value
-        line_parts = header_line.split(':')
-        # should be two parts
-        if len(line_parts) != 2:
-            return (False, False)
-        else:
-            # strip leading and trailing spaces
-            header_name = line_parts[0].strip()
-            header_value = line_parts[1].strip()
-            # return as tuple
-            return (header_name, header_value)
+    def parse_header_line(self, start, end):
+        # record offsets of header name and value, values trimmed of spaces
+        buf = self._buf
+        colon = start
+        while colon < end and buf[colon] != 58: # ':'
+            colon += 1
+        if colon >= end:
+            return
+        if self._hdrCount >= self.MAX_HEADERS:
+            logger.debug("More than %d headers, ignoring the rest", self.MAX_HEADERS)
+            return
+        nameEnd = colon
+        while nameEnd > start and buf[nameEnd - 1] == 32:
+            nameEnd -= 1
+        valStart = colon + 1
+        while valStart < end and (buf[valStart] == 32 or buf[valStart] == 9):
+            valStart += 1
+        while end > valStart and (buf[end - 1] == 32 or buf[end - 1] == 9):
+            end -= 1
+        i = self._hdrCount * 4
+        h = self._hdrs
+        h[i] = start
+        h[i + 1] = nameEnd
+        h[i + 2] = valStart
+        h[i + 3] = end
+        self._hdrCount += 1
 
     def decode_query_string(self, query_string):
         # split query string on &
@@ -151,9 +409,9 @@ class RequestParser:
                 # correctly formatted value
                 # splits into 2 on =
                 key, value = param_string.split('=')
-                # values may be url encoded
-                # unquote decodes special characters (well just a couple!)
-                value = self.unquote(value)
+                # keys and values may be url encoded
+                key = url_decode(key)
+                value = url_decode(value)
             except:
                 # no value specified
                 key = param_string
@@ -223,21 +481,16 @@ class RequestParser:
             # process next section
 
     def parse_content_form_url_encoded(self):
-        # first line of content will contain data
-        self.post_data = self.decode_query_string(self.content[0])
+        # the whole body is the encoded data
+        self.post_data = self.decode_query_string(self.body_text().strip())
 
     def parse_json_body(self):
-        # content contains json string
-        line_num = 0  # first line in content
-        json_string = ""
-        # build json string from content lines
-        while line_num < len(self.content):
-            if len(json_string) > 0:
-                json_string += "\n"
-            json_string += self.content[line_num]
-            line_num += 1
-        # parse json string to dictionary
-        self.post_data = json.loads(json_string)
+        # body is a json string; parse it to a dictionary
+        try:
+            self.post_data = json.loads(self.body_text())
+        except ValueError as e:
+            logger.warning("Bad JSON body: %s", e)
+            self.error = 400
 
     def url_match(self, test_url):
         # make sure string is cleaned and has leading /
@@ -253,12 +506,37 @@ class RequestParser:
         else:
             return False
 
-    def unquote(self, url_string):
-        # replaces %20 with space
-        # %0A with newline
-        url_string = re.sub(r'%20', ' ', url_string)
-        url_string = re.sub(r'%0A', '\n', url_string)
-        return url_string
+    # return True if the client wants the connection kept open after this request
+    # HTTP/1.1 defaults to keep-alive, HTTP/1.0 has to ask for it
+    def keep_alive(self):
+        connection = self.get_header_value('Connection')
+        if connection:
+            connection = connection.lower()
+            if connection.find('close') != -1:
+                return False
+            if connection.find('keep-alive') != -1:
+                return True
+        return self.protocol == 'HTTP/1.1'
+
+    # return True if the client will take a gzip-encoded response
+    def accepts_gzip(self):
+        accept = self.get_header_value('Accept-Encoding')
+        if not accept:
+            return False
+        for coding in accept.split(','):
+            parts = coding.split(';')
+            if parts[0].strip().lower() == 'gzip':
+                # "gzip;q=0" means anything but
+                for param in parts[1:]:
+                    param = param.strip()
+                    if param.startswith('q='):
+                        try:
+                            if float(param[2:]) == 0:
+                                return False
+                        except ValueError:
+                            pass
+                return True
+        return False
 
     # return relevant data set depending on request method
     # Can be set to "ERROR" by parse_first_line if it is != 3 parts
@@ -285,7 +563,7 @@ class RequestParser:
                 return False
         else:
             return False
-        
+
     # return the actual URL with no query values etc.
     def get_url(self):
         return self.url
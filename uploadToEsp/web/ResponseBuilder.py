@@ -6,60 +6,133 @@
     __init__
         Provide a doc root or default to "/html"; if it doesn't include a
         "/" at the beginnign it gets added anyway!
+        Provide the DocIndex of the doc root, otherwise one gets built
+        Optionally provide a ResponseCache for small static files
     
     serve_static_file
         Serves the specified static file, if url = "/" then either the specified
         default file, or if not specified, "index.html"
         Sets content-type depending on the file suffix
+        If the client accepts gzip and there is a "<file>.gz" alongside the file,
+        that is served instead with "Content-Encoding: gzip" - see gzipDocs.py
+        Adds ETag/Last-Modified/Cache-Control, and if the request's If-None-Match
+        or If-Modified-Since shows the client already has it, 304 with no body
+        With a ResponseCache, small files on keep-alive connections are sent from
+        (and the first time, stored in) RAM as a complete response
+        A single "Range: bytes=a-b" (or "a-", or "-n" for the last n bytes) gets just
+        that part of the (uncompressed, if there's a choice) file, so downloads can be
+        resumed and growing logs tailed; If-Range is honoured
         Sets HTTP response:
             200 - file exists
+            206 - the range asked for
             404 - file doesn't exist
+            416 - the range starts beyond the end of the file
+
+    head
+        Set for a HEAD request: send() sends the headers - Content-Length included -
+        but no body
             
     set_body_from_dict
         Sets text to JSON stringify of the provided dictionary object
         Sets content-type to "application/json"
         
+    set_keep_alive
+        Sets whether the connection stays open after the response, and the
+        timeout/remaining request count advertised to the client
+        
+    send
+        Writes the response to the stream, returning whether the connection can be
+        kept open. The status line and headers are put together from ready-encoded
+        templates in a send buffer shared by all responses; a body (or file) that
+        fits in behind them goes out in the same write, bigger files are streamed
+        through the buffer a buffer-full per write
+
     build_response
-        Creates response message using stored values etc.
-        Files are opened, the fd stored in the ResponseBuilder object, and the caller
-        then iterates reading/writing the file. Should really be passed the write stream
-        so this class can do the iteration!
+        Creates the response message as bytes using stored values etc., without the
+        file contents unless the response is to be cached
 
 """
 
 
+import sys
 import json
-import os
 import logging
 
 from micropython import const
 from ESPLogRecord import ESPLogRecord
 logger = logging.getLogger(__name__)
 
-# List of handled file types and returned content-type
+# List of handled file types and returned content-type, with the Cache-Control max-age
+# in secs browsers may use them without checking back; 0 means check every time, which
+# is still cheap because unchanged files get a bodyless 304 Not Modified
 # Based on iana.org/assignments/media-types/media-types.xhtml
 fileToContentType = {
-    const("htm"):	const("text/html"),
-    const("html"):	const("text/html"),
-    const("css"):	const("text/css"),
-    const("csv"):	const("text/csv"),
-    const("md"):	const("text/markdown"),
-    const("rtf"):	const("text/richtext"),
-    const("xml"):	const("text/xml"),
-    const("unknown"):const("text/plain"),
+    const("js"):	(const("text/javascript"), 3600),
+    const("htm"):	(const("text/html"), 0),
+    const("html"):	(const("text/html"), 0),
+    const("css"):	(const("text/css"), 3600),
+    const("csv"):	(const("text/csv"), 0),
+    const("md"):	(const("text/markdown"), 0),
+    const("rtf"):	(const("text/richtext"), 0),
+    const("xml"):	(const("text/xml"), 0),
+    const("unknown"):(const("text/plain"), 0),
     }
 
+# Headers and small bodies are assembled here and sent with a single write(). MicroPython's
+# Stream.write() copies the data, and nothing awaits between filling the buffer and writing
+# it, so one buffer serves every connection. CPython's transports can keep a view of what
+# they haven't sent yet, even after drain(), so on a computer each write gets a copy
+SEND_BUFFER_SIZE = const(1536)
+_sendBuf = bytearray(SEND_BUFFER_SIZE)
+_sendMv = memoryview(_sendBuf)
+_writeCopies = sys.implementation.name == "micropython"
+
+def _sendable(mv, n):
+    return mv[:n] if _writeCopies else bytes(mv[:n])
+
+_statusLines = {}	# status -> b"HTTP/1.1 200 OK\r\nServer: ...\r\n"
+_typeHeaders = {}	# content type -> b"Content-Type: ...\r\n"
+
+def _put(buf, pos, data):
+    end = pos + len(data)
+    buf[pos:end] = data
+    return end
+
+def _putInt(buf, pos, n):
+    # Decimal digits straight into the buffer, no str needed
+    end = pos + 1
+    v = n // 10
+    while v:
+        end += 1
+        v //= 10
+    i = end
+    while True:
+        i -= 1
+        buf[i] = 48 + n % 10
+        n //= 10
+        if not n:
+            return end
+
 class ResponseBuilder:
     protocol = "HTTP/1.1"
     server = "ESP Micropython"
 
-    def __init__(self, root="/"):
+    def __init__(self, root="/", index=None, cache=None):
         # set default values
         # Better check it... and fix because I can't be bothered to
         # sort out everything after it's wrong
         if root[0] != "/":
             root = "/" + root
         self.docroot = root
+        if index is None:
+            # Nobody's built one for us - expensive, so share one where you can!
+            from web.DocIndex import DocIndex
+            index = DocIndex(root)
+        self.index = index
+        self.cache = cache
+        self.cacheKey = None	# Set if the response should be cached once built
+        self.cached = None		# Complete response from the cache
+        self.path = None		# URL path of the static file served
         self.status = 200
         self.content_type = "text/html"
         self.body = ""
@@ -68,6 +141,16 @@ class ResponseBuilder:
         self.contentLen = 0
         self.fd = None
         self.isFile = False
+        self.contentEncoding = None
+        self.etag = None
+        self.lastModified = None
+        self.validators = None	# Header lines from the DocIndex entry for static files
+        self.contentRange = None	# (first byte, last byte, file size) of a 206, (None, None, size) for 416
+        self.head = False
+        self.maxAge = -1		# No Cache-Control header
+        self.keepAlive = False
+        self.keepAliveTimeout = 0
+        self.keepAliveMax = 0
 
     def set_content_type(self, content_type):
         self.content_type = content_type
@@ -76,9 +159,17 @@ class ResponseBuilder:
         self.status = status
 
     def set_body(self, body):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
         self.body = body
+        self.contentLen = len(body)
 
-    def serve_static_file(self, req_filename, default_file="/index.html"):
+    def set_keep_alive(self, keepAlive, timeout=5, maxRequests=100):
+        self.keepAlive = keepAlive
+        self.keepAliveTimeout = timeout
+        self.keepAliveMax = maxRequests
+
+    def serve_static_file(self, req_filename, default_file="/index.html", request=None):
         # make sure filename starts with /
         if req_filename.find("/") == -1:
             req_filename = "/" + req_filename
@@ -91,79 +182,285 @@ class ResponseBuilder:
         # filter out default file
         if req_filename == "/":
             req_filename = default_file
-        # break filename into path and filename
-        path, filename = req_filename.rsplit("/", 1)
-        # reinstate root path for listdir
-        if len(path) == 0:
-            path = "/"
-        # Add docroot
-        path = path + self.docroot
-        logger.debug("Path: %s Filename: %s", path, filename)
-        #print(path, filename)
-        # make sure working from root directory
-        os.chdir("/")
-        # get directory listing
+        self.path = req_filename
+        # look it up in the docroot index rather than scanning flash
+        entry = self.index.lookup(req_filename)
+        logger.debug("Filename: %s Entry: %s", req_filename, entry)
+        if entry is None:
+            # file not found
+            self.set_status(404)
+            return
+        # file found
+        self.content_type = entry.content_type
+        # set up content
+        filenameFull = self.index.fullPath(req_filename)
+        # Ranges are wanted in the uncompressed file, so use that if there is one
+        ranged = request is not None and entry.size >= 0 and request.get_header_value('Range')
+        useGzip = entry.gzSize > 0 and request is not None and request.accepts_gzip() and not ranged
+        if useGzip:
+            filenameFull = filenameFull + ".gz"
+            self.contentEncoding = "gzip"
+            self.contentLen = entry.gzSize
+        elif entry.size < 0:
+            # Only the compressed version is here, and the client can't take it
+            logger.warning("Only %s.gz available, client doesn't accept gzip", req_filename)
+            self.set_status(406)
+            return
+        else:
+            self.contentLen = entry.size
+        # validators, so the client can ask "has it changed?" next time
+        self.etag = entry.etag(useGzip)
+        self.lastModified = entry.lastModified()
+        self.validators = entry.validators(useGzip)
+        if request is not None and self.not_modified(request):
+            self.contentLen = 0
+            self.set_status(304)
+            return
+        byteRange = self.byte_range(request, self.contentLen) if ranged else None
+        if byteRange is False:
+            self.contentRange = (None, None, self.contentLen)
+            self.contentLen = 0
+            self.set_status(416)
+            return
+        if self.head:
+            # All that's wanted is the headers
+            self.set_range(byteRange)
+            return
+        # Cached responses say keep-alive, so only use them on keep-alive connections
+        if self.cache is not None and self.keepAlive and byteRange is None:
+            self.cached = self.cache.get(filenameFull)
+            if self.cached is not None:
+                self.set_status(200)
+                return
+            if self.contentLen <= self.cache.maxItemSize:
+                self.cacheKey = filenameFull
         try:
-            dir_contents = os.listdir(path)
-        except Exception as e:
-            logger.warning("Exception: %s Path: %s Filename: %s", e, path, filename)
-            dir_contents = []
-        # check if file exists
-        if filename in dir_contents:
-            # file found
-            # get file type
-            name, file_type = filename.rsplit(".", 1)
-            if file_type in fileToContentType:
-                self.content_type = fileToContentType[file_type]
-            else:
-                self.content_type = fileToContentType['unknown']
-            # set up content
-            filenameFull = path + "/" + filename
-            self.contentLen = os.stat(filenameFull)[6]
             self.fd = open(filenameFull, 'rb') # Read as a proper bytes file
-            self.isFile = True
-            self.set_status(200)
-        else:
-            # file not found
+        except OSError as e:
+            # Gone since it was indexed
+            logger.warning("Exception: %s opening indexed file %s", e, filenameFull)
+            self.index.invalidate(req_filename)
+            self.contentEncoding = None
             self.set_status(404)
+            return
+        self.isFile = True
+        if byteRange is not None:
+            self.fd.seek(byteRange[0])
+        self.set_range(byteRange)
+
+    def set_range(self, byteRange):
+        # 200 for all of it, or 206 with the length and Content-Range of the part
+        if byteRange is None:
+            self.set_status(200)
+            return
+        self.contentRange = (byteRange[0], byteRange[1], self.contentLen)
+        self.contentLen = byteRange[1] - byteRange[0] + 1
+        self.set_status(206)
+
+    def byte_range(self, request, size):
+        # The (first, last) byte of a single "bytes=" range the request asks for; None if there
+        # isn't one we can use, so all of it is sent, or False if it's beyond the end of the file
+        spec = request.get_header_value('Range')
+        if not spec or not spec.startswith("bytes=") or spec.find(",") >= 0:
+            return None # Several ranges is allowed to get the whole thing
+        ifRange = request.get_header_value('If-Range')
+        if ifRange and ifRange != self.etag and ifRange != self.lastModified:
+            return None # Changed since the client got the first part, so it needs the lot
+        parts = spec[6:].strip().split("-", 1)
+        if len(parts) != 2:
+            return None
+        try:
+            if parts[0] == "": # Suffix - the last n bytes
+                n = int(parts[1])
+                if n <= 0:
+                    return False
+                return (max(0, size - n), size - 1) if size > 0 else False
+            first = int(parts[0])
+            last = int(parts[1]) if parts[1] else size - 1
+        except ValueError:
+            return None
+        if first >= size:
+            return False
+        if first < 0 or last < first:
+            return None
+        return (first, min(last, size - 1))
+
+    def not_modified(self, request):
+        # If-None-Match wins if both are there (RFC 9110 13.2.2)
+        ifNoneMatch = request.get_header_value('If-None-Match')
+        if ifNoneMatch:
+            for tag in ifNoneMatch.split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'): # Weak comparison is allowed for GET
+                    tag = tag[2:]
+                if tag == self.etag or tag == '*':
+                    return True
+            return False
+        # Browsers send back exactly the Last-Modified we gave them, so no need to parse it
+        ifModifiedSince = request.get_header_value('If-Modified-Since')
+        return ifModifiedSince == self.lastModified
 
     def set_body_from_dict(self, dictionary):
-        self.body = json.dumps(dictionary)
+        # Encoded so Content-Length is in bytes, not chars - keep-alive clients rely on it
+        self.body = json.dumps(dictionary).encode("utf-8")
         self.set_content_type("application/json")
         # added
         self.contentLen = len(self.body)
 
+    def _status_line(self):
+        line = _statusLines.get(self.status)
+        if line is None:
+            line = ("%s %d %s\r\nServer: %s\r\n" % (self.protocol, self.status,
+                    self.get_status_message(), self.server)).encode()
+            _statusLines[self.status] = line
+        return line
+
+    def _build_headers(self):
+        # Status line and headers into the send buffer, returns their length
+        buf = _sendBuf
+        n = _put(buf, 0, self._status_line())
+        if self.status != 304: # Not modified has no content to describe
+            typeHeader = _typeHeaders.get(self.content_type)
+            if typeHeader is None:
+                typeHeader = ("Content-Type: " + self.content_type + "\r\n").encode()
+                _typeHeaders[self.content_type] = typeHeader
+            n = _put(buf, n, typeHeader)
+            n = _put(buf, n, b"Content-Length: ")
+            n = _putInt(buf, n, self.contentLen)
+            n = _put(buf, n, b"\r\n")
+            if self.contentRange is not None:
+                first, last, size = self.contentRange
+                if first is None:
+                    n = _put(buf, n, b"Content-Range: bytes */")
+                else:
+                    n = _put(buf, n, b"Content-Range: bytes ")
+                    n = _putInt(buf, n, first)
+                    n = _put(buf, n, b"-")
+                    n = _putInt(buf, n, last)
+                    n = _put(buf, n, b"/")
+                n = _putInt(buf, n, size)
+                n = _put(buf, n, b"\r\n")
+            if self.contentEncoding == "gzip":
+                n = _put(buf, n, b"Content-Encoding: gzip\r\n")
+            elif self.contentEncoding:
+                n = _put(buf, n, ("Content-Encoding: " + self.contentEncoding + "\r\n").encode())
+        if self.validators is not None:
+            n = _put(buf, n, self.validators)
+        elif self.maxAge > 0:
+            n = _put(buf, n, b"Cache-Control: max-age=")
+            n = _putInt(buf, n, self.maxAge)
+            n = _put(buf, n, b"\r\n")
+        elif self.maxAge == 0:
+            n = _put(buf, n, b"Cache-Control: no-cache\r\n")
+        if self.keepAlive:
+            n = _put(buf, n, b"Connection: keep-alive\r\nKeep-Alive: timeout=")
+            n = _putInt(buf, n, self.keepAliveTimeout)
+            if self.cacheKey is None: # Cached responses are reused, so no request count
+                n = _put(buf, n, b", max=")
+                n = _putInt(buf, n, self.keepAliveMax)
+            n = _put(buf, n, b"\r\n\r\n")
+        else:
+            n = _put(buf, n, b"Connection: close\r\n\r\n")
+        return n
+
     def build_response(self):
-        self.response = ""
-        # status line
-        self.response += self.__class__.protocol \
-                         + " " \
-                         + str(self.status) \
-                         + " " \
-                         + self.get_status_message() \
-                         + "\r\n"
-        # Headers
-        self.response += "Server: " + self.server + "\r\n"
-        self.response += "Content-Type: " + self.content_type + "\r\n"
-        #self.response += "Content-Length: " + str(len(self.body)) + "\r\n"
-        self.response += "Content-Length: " + str(self.contentLen) + "\r\n"
-        self.response += "Connection: Closed\r\n"
-        self.response += "\r\n"
-        # body
-        """
-            Body now handled using self.fd, passed to something that has
-            the output stream handler as well
-        """
+        if self.cached is not None:
+            self.response = self.cached
+            return
+        self.response = bytes(_sendMv[:self._build_headers()])
+        if self.cacheKey is not None and self.isFile:
+            self._read_into_response()
         if not self.isFile:
+            if isinstance(self.body, str):
+                self.body = self.body.encode("utf-8")
             self.response += self.body
 
+    async def send(self, writer):
+        if self.cached is not None or (self.isFile and self.cacheKey is not None):
+            # Complete response in RAM (reading the file in and caching it if need be)
+            self.build_response()
+            writer.write(self.response)
+            await writer.drain()
+            return self.keepAlive
+        buf = _sendBuf
+        mv = _sendMv
+        n = self._build_headers()
+        if self.head:
+            writer.write(_sendable(mv, n))
+            await writer.drain()
+        elif self.isFile:
+            # Fill the buffer up behind the headers and keep going until it's all sent
+            remaining = self.contentLen
+            with self.fd as fd:
+                while remaining > 0:
+                    readLen = fd.readinto(mv[n:n + min(remaining, SEND_BUFFER_SIZE - n)])
+                    if not readLen: # File shrank under us - Content-Length is now wrong
+                        self.keepAlive = False
+                        break
+                    remaining -= readLen
+                    n += readLen
+                    if n == SEND_BUFFER_SIZE or remaining == 0:
+                        writer.write(_sendable(mv, n))
+                        await writer.drain()
+                        n = 0
+            self.fd = None
+            if n: # Whatever there was before the file ran out
+                writer.write(_sendable(mv, n))
+                await writer.drain()
+        else:
+            body = self.body
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            if n + len(body) <= SEND_BUFFER_SIZE:
+                n = _put(buf, n, body)
+                writer.write(_sendable(mv, n))
+            else:
+                writer.write(_sendable(mv, n))
+                writer.write(body)
+            await writer.drain()
+        return self.keepAlive
+
+    def _read_into_response(self):
+        # Reads the whole file in behind the headers, so the response can be cached and
+        # sent in one go rather than streamed from the file
+        headLen = len(self.response)
+        response = bytearray(headLen + self.contentLen)
+        response[0:headLen] = self.response
+        mv = memoryview(response)
+        have = headLen
+        with self.fd as fd:
+            while have < len(response):
+                n = fd.readinto(mv[have:])
+                if not n:
+                    break
+                have += n
+        self.fd = None
+        self.isFile = False
+        self.body = b""
+        self.response = response
+        if have == len(response):
+            self.cache.put(self.cacheKey, response, self.contentLen)
+        else:
+            # File shrank under us - don't keep it, and don't send the garbage on the end
+            logger.warning("%s shorter than indexed, not cached", self.cacheKey)
+            self.keepAlive = False
+            self.response = mv[:have]
+            self.index.invalidate(self.path)
+
     def get_status_message(self):
         status_messages = {
             200: "OK",
+            206: "Partial Content",
+            304: "Not Modified",
             400: "Bad Request",
             403: "Forbidden",
             404: "Not Found",
-            422: "UnprocessableContent"
+            406: "Not Acceptable",
+            408: "Request Timeout",
+            413: "Content Too Large",
+            416: "Range Not Satisfiable",
+            422: "Unprocessable Content",
+            431: "Request Header Fields Too Large"
         }
         if self.status in status_messages:
             return status_messages[self.status]
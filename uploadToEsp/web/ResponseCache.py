@@ -0,0 +1,95 @@
+"""
+    ResponseCache
+    Keeps complete, ready-to-send responses (headers + body) for small static files
+    in RAM, so a hit is a single writer.write() with no file access at all.
+
+    __init__
+        budget - total bytes of responses to hold
+        maxItemSize - files bigger than this are never cached
+        memWatermark - if gc.mem_free() drops below this, least recently used
+            responses are thrown away until it is back above it (or the cache is empty)
+
+    get/put
+        Keyed on the full path of the file actually served (so "x.html" and
+        "x.html.gz" are separate entries). put() is given the body size as well,
+        which is what maxItemSize is held to; the budget counts the headers too
+
+    invalidate
+        Drop the entries for a file (both variants), or everything
+
+"""
+import gc
+import logging
+from micropython import const
+
+logger = logging.getLogger(__name__)
+from ESPLogRecord import ESPLogRecord
+logger.record = ESPLogRecord()
+
+class ResponseCache:
+
+    def __init__(self, budget=12288, maxItemSize=6144, memWatermark=30000):
+        self.budget = budget
+        self.maxItemSize = maxItemSize
+        self.memWatermark = memWatermark
+        self.entries = {}	# key -> [response, last used]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._tick = 0		# Use counter for LRU - only a handful of entries, so a scan is fine
+
+    def get(self, key):
+        self.shrink()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._tick += 1
+        entry[1] = self._tick
+        return entry[0]
+
+    def put(self, key, response, bodySize):
+        size = len(response)
+        if bodySize > self.maxItemSize or size > self.budget:
+            return
+        if key in self.entries:
+            self._remove(key)
+        while self.entries and self.size + size > self.budget:
+            self._evict()
+        self.shrink()
+        if gc.mem_free() < self.memWatermark:
+            return # No room at the inn
+        self._tick += 1
+        self.entries[key] = [response, self._tick]
+        self.size += size
+        logger.debug(const("Cached %s %d bytes, total %d"), key, size, self.size)
+
+    def shrink(self):
+        """ Gives memory back while the heap is below the watermark """
+        while self.entries and gc.mem_free() < self.memWatermark:
+            self._evict()
+            gc.collect()
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.entries = {}
+            self.size = 0
+        else:
+            for k in (key, key + ".gz"):
+                if k in self.entries:
+                    self._remove(k)
+
+    def _evict(self):
+        lruKey = None
+        lruTick = 0
+        for k, entry in self.entries.items():
+            if lruKey is None or entry[1] < lruTick:
+                lruKey = k
+                lruTick = entry[1]
+        logger.debug(const("Evicting %s"), lruKey)
+        self._remove(lruKey)
+
+    def _remove(self, key):
+        self.size -= len(self.entries[key][0])
+        del self.entries[key]
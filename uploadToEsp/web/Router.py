@@ -0,0 +1,77 @@
+"""
+    Router
+    Table of (method, path) -> handler, built once at startup, so finding the handler
+    for a request is a dict lookup however many endpoints there are.
+
+    add(method, path, handler)
+        path is one of
+        - exact e.g. "/data"
+        - with parameters e.g. "/cmd/<action>" - each <name> matches one path segment
+        - a prefix e.g. "/file/*" - "*" (last segment only) matches the rest of the path
+        Exact paths go straight into a dict; the others are filed under their first
+        segment (which must be literal) so only routes starting the same way are tried
+
+    match(method, path)
+        Returns (handler, params, route), params being a dict of the matched <name>s
+        (and "*"), or None for an exact match, and route the path it was added with;
+        (None, None, None) if nothing matches
+
+    Handlers are called handler(request, response, params) where response is the
+    ResponseBuilder for the request; they may be plain functions or coroutines. A handler
+    that has written to the connection itself (event streams, WebSockets) returns False
+    and the connection is closed afterwards.
+"""
+
+class Router:
+
+    def __init__(self):
+        self.routes = {}	# (method, path) -> handler
+        self.patterns = {}	# (method, first segment) -> [(segments, handler, path)]
+
+    def add(self, method, path, handler):
+        if "<" in path or path.endswith("/*"):
+            segments = path.strip("/").split("/")
+            if segments[0][:1] == "<" or segments[0] == "*":
+                raise ValueError("First segment of route %s must be literal" % path)
+            key = (method, segments[0])
+            if key not in self.patterns:
+                self.patterns[key] = []
+            self.patterns[key].append((segments, handler, path))
+        else:
+            self.routes[(method, path)] = handler
+
+    def match(self, method, path):
+        handler = self.routes.get((method, path))
+        if handler is not None:
+            return (handler, None, path)
+        if not self.patterns:
+            return (None, None, None)
+        end = path.find("/", 1)
+        candidates = self.patterns.get((method, path[1:end] if end > 0 else path[1:]))
+        if candidates is None:
+            return (None, None, None)
+        segments = path.strip("/").split("/")
+        for pattern, handler, route in candidates:
+            params = self._match(pattern, segments)
+            if params is not None:
+                return (handler, params, route)
+        return (None, None, None)
+
+    def _match(self, pattern, segments):
+        params = {}
+        n = len(pattern)
+        for i in range(n):
+            p = pattern[i]
+            if p == "*" and i == n - 1:
+                params["*"] = "/".join(segments[i:])
+                return params
+            if i >= len(segments):
+                return None
+            if p[:1] == "<":
+                if not segments[i]:
+                    return None
+                params[p[1:-1]] = segments[i]
+            elif p != segments[i]:
+                return None
+        return params if len(segments) == n else None
+
@@ -1,6 +1,6 @@
-version = 1.1 # Now handles "action" URL using a provided actionHandler callback
+version = 3.0 # /history?from=&to=: samples streamed from the flash SampleLog
 
-import asyncio, time, random, logging
+import asyncio, time, random, logging, json, gc
 from micropython import const
 
 logger = logging.getLogger(__name__)
@@ -10,12 +10,32 @@ logger.record = ESPLogRecord()
 
 from web.RequestParser import RequestParser
 from web.ResponseBuilder import ResponseBuilder
-from web.url_parse import url_parse
+from web.DocIndex import DocIndex
+from web.ResponseCache import ResponseCache
+from web.WebSocket import WebSocket
+from web.Router import Router
+from web.AccessLog import AccessLog
+from web import cbor
+from Metrics import metrics
 
+# Prebuilt so turning a client away costs next to nothing
+_busyResponse = const(b"HTTP/1.1 503 Service Unavailable\r\nServer: ESP Micropython\r\nRetry-After: 5\r\n"
+                      b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+
+_requests = metrics.counter("http_requests_total", "Requests by route and status", ("route", "status"))
+_responseBytes = metrics.counter("http_response_bytes_total", "Response body bytes by route", ("route",))
+_latency = metrics.histogram("http_request_duration_ms", "Time from first byte of request to response sent",
+                             (5, 10, 25, 50, 100, 250, 500, 1000, 2500), ("route",))
 
 class WebServer:
 
-    def __init__(self, dataSources, actionHandler, docroot="/html", port=80):
+    def __init__(self, dataSources, actionHandler, docroot="/html", port=80,
+                 keepAliveTimeout=5, maxKeepAliveRequests=100, maxBodySize=RequestParser.MAX_BODY_SIZE,
+                 cacheBudget=12288, cacheMaxItemSize=6144, cacheMemWatermark=30000,
+                 dataEvent=None, maxEventClients=4, eventHeartbeat=15, maxWebSocketClients=4,
+                 maxConnections=8, maxQueued=8, queueTimeout=5, shedMemWatermark=20000,
+                 headerTimeout=5, bodyTimeout=10, writeTimeout=10, requestTimeout=30,
+                 accessLogSize=64, accessLogFile=None, accessLogFlush=60):
         logger.info(const("initialising v%.2f: Data Sources: %s"), version, dataSources)
         if actionHandler == None:
             self.actionHandler = self._actionHandler
@@ -23,9 +43,168 @@ class WebServer:
             self.actionHandler = actionHandler
         self.dataSources = dataSources
         self.docroot = docroot
+        self.docIndex = DocIndex(docroot)	# Saves scanning flash for every static file
+        # Complete responses for small, popular files kept in RAM; cacheBudget=0 turns it off
+        self.responseCache = None
+        if cacheBudget > 0:
+            self.responseCache = ResponseCache(cacheBudget, cacheMaxItemSize, cacheMemWatermark)
+        self.keepAliveTimeout = keepAliveTimeout			# Secs an idle connection is kept open
+        self.maxKeepAliveRequests = maxKeepAliveRequests	# Requests served before closing anyway
+        self.maxBodySize = maxBodySize						# Larger request bodies get a 413
+        # Slow clients: once a request has started, secs allowed for the rest of its headers, for
+        # its body, and for sending the response; requestTimeout caps the whole thing, reading and
+        # writing. A request that runs out of time reading gets a 408 and the connection is closed
+        self.headerTimeout = headerTimeout
+        self.bodyTimeout = bodyTimeout
+        self.writeTimeout = writeTimeout
+        self.requestTimeout = requestTimeout
+        self.timeoutsNoRequest = 0	# Connections that never sent anything
+        self.timeoutsHeader = 0
+        self.timeoutsBody = 0
+        self.timeoutsWrite = 0		# Responses (and event streams) the client wasn't taking
+        # /events (Server-Sent Events): pushes the data whenever dataEvent is set (e.g. Sensor.newData),
+        # or it's checked every second if there isn't one; a comment line every eventHeartbeat secs
+        # keeps quiet connections alive
+        self.dataEvent = dataEvent
+        self.maxEventClients = maxEventClients
+        self.eventHeartbeat = eventHeartbeat
+        self.eventClients = 0
+        # /ws WebSocket: same data pushes, plus actions sent back the other way
+        self.maxWebSocketClients = maxWebSocketClients
+        self.webSocketClients = 0
+        # Admission control: at most maxConnections handled at once, up to maxQueued more wait up
+        # to queueTimeout secs for a slot, and everything else - or anything at all while
+        # gc.mem_free() is below shedMemWatermark - gets a 503. Event streams and WebSockets give
+        # their slot back once they start (they have their own limits above), and a kept-alive
+        # connection waiting for its next request gives it up as soon as anyone is queued
+        self.maxConnections = maxConnections
+        self.maxQueued = maxQueued
+        self.queueTimeout = queueTimeout
+        self.shedMemWatermark = shedMemWatermark
+        self._slotFree = asyncio.Event()
+        self.connectionsActive = 0
+        self.connectionsQueued = 0
+        self.slotsYielded = 0			# Idle connections closing to let a queued one in
+        self.connectionsAccepted = 0
+        self.connectionsShed = 0
+        self.connectionsShedMemory = 0	# Of connectionsShed, how many for lack of heap
+        self.requestsShed = 0			# Requests on open connections turned away for lack of heap
+        # Every request goes in a ring buffer of the last accessLogSize, served at /accesslog, and
+        # if there's an accessLogFile it's appended to that every accessLogFlush secs
+        self.accessLog = AccessLog(accessLogSize, accessLogFile, accessLogFlush)
+        if accessLogFile is not None:
+            asyncio.create_task(self.accessLog.run())
+        # Endpoints - anything else is looked for in the docroot. Sensors etc. can add their own
+        # with route()
+        self.router = Router()
+        self.route("GET", "/data", self._data)
+        self.route("GET", "/data.bin", self._dataCBOR)
+        self.route("GET", "/stats", self._stats)
+        self.route("GET", "/config", self._config)
+        self.route("POST", "/action", self._action)
+        self.route("POST", "/cmd/<action>", self._cmd)
+        self.route("GET", "/events", self._events)
+        self.route("GET", "/ws", self._websocket)
+        self.route("GET", "/metrics", self._metrics)
+        self.route("GET", "/accesslog", self._accessLog)
+        self.route("GET", "/history", self._history)
+        metrics.collect("webserver", self.getStats)
+        metrics.collect("accesslog", self.accessLog.getStats)
         server = asyncio.start_server(self.handle_request, "0.0.0.0", port)        
         asyncio.create_task(server)
                 
+    def route(self, method, path, handler):
+        """ Adds an endpoint e.g. route("GET", "/sensor/<name>", handler) - see web.Router """
+        self.router.add(method, path, handler)
+
+    def invalidateDocs(self, path=None):
+        """ Tell the server docroot files have changed: path e.g. "/data.csv", or None for everything """
+        self.docIndex.invalidate(path)
+        if self.responseCache is not None:
+            self.responseCache.invalidate(None if path is None else self.docIndex.fullPath(path))
+
+    def getStats(self):
+        """ Connection counters, also served as JSON at /stats """
+        return {"active": self.connectionsActive, "queued": self.connectionsQueued,
+                "accepted": self.connectionsAccepted, "shed": self.connectionsShed,
+                "shedMemory": self.connectionsShedMemory, "requestsShed": self.requestsShed,
+                "eventClients": self.eventClients, "webSocketClients": self.webSocketClients,
+                "timeoutsNoRequest": self.timeoutsNoRequest, "timeoutsHeader": self.timeoutsHeader,
+                "timeoutsBody": self.timeoutsBody, "timeoutsWrite": self.timeoutsWrite,
+                "memFree": gc.mem_free()}
+
+    def getConfig(self):
+        """ Server settings, also served as JSON at /config """
+        return {"version": version, "docroot": self.docroot,
+                "keepAliveTimeout": self.keepAliveTimeout, "maxKeepAliveRequests": self.maxKeepAliveRequests,
+                "headerTimeout": self.headerTimeout, "bodyTimeout": self.bodyTimeout,
+                "writeTimeout": self.writeTimeout, "requestTimeout": self.requestTimeout,
+                "maxBodySize": self.maxBodySize, "maxConnections": self.maxConnections,
+                "maxQueued": self.maxQueued, "maxEventClients": self.maxEventClients,
+                "maxWebSocketClients": self.maxWebSocketClients, "eventHeartbeat": self.eventHeartbeat,
+                "cacheBudget": self.responseCache.budget if self.responseCache is not None else 0}
+
+    def _heapLow(self):
+        if gc.mem_free() >= self.shedMemWatermark:
+            return False
+        gc.collect() # Might just be garbage
+        return gc.mem_free() < self.shedMemWatermark
+
+    async def _admit(self):
+        # Returns True once the connection has a slot, False if it should be shed
+        if self._heapLow():
+            self.connectionsShedMemory += 1
+            return False
+        if self.connectionsActive >= self.maxConnections:
+            if self.connectionsQueued >= self.maxQueued:
+                return False
+            self.connectionsQueued += 1
+            # queueTimeout in all, however many times another waiter gets the freed slot first
+            deadline = time.ticks_add(time.ticks_ms(), int(self.queueTimeout * 1000))
+            try:
+                while self.connectionsActive >= self.maxConnections:
+                    left = time.ticks_diff(deadline, time.ticks_ms())
+                    if left <= 0:
+                        return False
+                    await asyncio.wait_for(self._slotFree.wait(), left / 1000)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self.connectionsQueued -= 1
+                if self.slotsYielded:
+                    self.slotsYielded -= 1
+        self.connectionsActive += 1
+        self.connectionsAccepted += 1
+        return True
+
+    def _release(self):
+        self.connectionsActive -= 1
+        self._slotFree.set()
+        self._slotFree.clear() # Waiters have already been woken
+
+    def _detach(self, request):
+        # A long-lived stream is taking over the connection: free its slot for ordinary requests
+        if request.holdsSlot:
+            request.holdsSlot = False
+            self._release()
+
+    def _slotWanted(self):
+        # One idle connection gives way for each one queued
+        if self.connectionsQueued > self.slotsYielded:
+            self.slotsYielded += 1
+            return True
+        return False
+
+    async def _shed(self, writer):
+        self.connectionsShed += 1
+        try:
+            writer.write(_busyResponse)
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except Exception as e:
+            logger.debug(const("Exception shedding connection: %s"), str(e))
+
     @classmethod    
     def _actionHandler (self, action, params):
         logger.debug(const("actionHandler: action: %s params %s"), action, params)
@@ -40,15 +219,15 @@ class WebServer:
             if action == "network":
                 # Network config
                 # hostname, ssid, password
-                hostname = url_parse(params['hostname'])
-                ssid = url_parse(params['ssid'])
-                password = url_parse(params['password'])
+                hostname = params['hostname']
+                ssid = params['ssid']
+                password = params['password']
                 # not sure what to do with the hostname for now! Would have to put in NetCreds...
                 if ssid != "" and password != "":
                     logger.info(const("Network config updated: hostname: %s SSID: %s Pwd: %s"), hostname, ssid, "********")
             elif action == "message":
                 # MOTD
-                MOTD = url_parse(params['MOTD'])
+                MOTD = params['MOTD']
                 logger.info(const("MOTD updated: %s"), MOTD)
             return("thanks.html")
         else:
@@ -60,87 +239,496 @@ class WebServer:
     # coroutine to handle HTTP request
     # Presumably instantiated for every individual client, so that we have to keep buffers etc.
     # unique and within the scope of this function
+    # The connection is kept open for successive requests (HTTP/1.1 keep-alive) until the client
+    # asks to close it, it sits idle for keepAliveTimeout secs or it has served maxKeepAliveRequests
     async def handle_request(self, reader, writer):
         logger.debug(const("entering handle_request rd %s wr %s"), reader, writer)
+        if not await self._admit():
+            logger.warning(const("Connection shed: active: %d queued: %d mem free: %d"),
+                           self.connectionsActive, self.connectionsQueued, gc.mem_free())
+            await self._shed(writer)
+            return
         peerInfo = ()
+        request = None
         try:
-            peerInfo = reader.get_extra_info('peername')
-            # Horrible reading of large string object, but it works...
-            raw_request = await reader.read(2048)
-            request = RequestParser(raw_request)
-            
-            logger.info(const("Request Info: t: %d client: %s method: %s action: %s URL: %s"),
-                         time.time(), peerInfo, request.method, request.get_action(),
-                         request.full_url)
-            
-            response_builder = ResponseBuilder(self.docroot)
-
-            # filter out api request
-            if request.url_match("/data"):
-                # JS Fetch request for data
-                response_obj = [{'status': 0}]
-                for d in self.dataSources:
-                    values = d()
-                    for k, v in values.items():
-                        response_obj.append({k:v})
-                response_builder.set_body_from_dict(response_obj)
-                logger.debug(const("Response Body: %s"), response_builder.body)
-                del response_obj
-            elif request.url_match("/action"):
-                # Time to do something...
-                if "action" in request.post_data:
-                    action = request.post_data["action"]
-                    returnPage = self.actionHandler(action, request.post_data)
-                    if returnPage == "": # Whoops, unknown action!
-                        logger.error("Action '%s' not implemented or unknown! Fix HTML Form %s", action, request.url)
-                        response_builder.status = 422
-                    else:
-                        response_builder.serve_static_file(returnPage, returnPage)
-                else:
-                    # Whoops - no action param in returned form values - fix HTML!
-                    logger.error("No Action input element in Form - Fix HTML Form %s", request.url)
-                    response_builder.status = 422
-            else:
-                # try to serve static file
-                # ResponseBuilder checks it all out...
-                response_builder.serve_static_file(request.url, "/index.html")
-            
-            if response_builder.status != 200:
-                logger.warning(const("Error %d on Request %s"), response_builder.status, raw_request)
-
-            """
-            try/except/finally to handle running out of Heap Memory error,
-            largely alleviated now by the loop with a fixed length buffer read
-            and deleting local vars
-            """
+            peerInfo = writer.get_extra_info('peername') # reader and writer are the same Stream in MicroPython
+            # One parser per connection, so its buffer is reused for every request on it
+            request = RequestParser(maxBodySize=self.maxBodySize)
+            request.holdsSlot = True	# Until a stream handler _detach()es it
+            request.reader = reader
+            request.writer = writer
+            request.peerInfo = peerInfo
+            requestCount = 0
+            keepAlive = True
+            while keepAlive:
+                # Between requests, give the slot up to anyone queued for one
+                ok = await request.read(reader, self.keepAliveTimeout, self.headerTimeout, self.bodyTimeout,
+                                        self._slotWanted if requestCount else None, self.requestTimeout)
+                if request.timedOut == "idle":
+                    logger.debug(const("Client %s idle after %d requests - closing"), peerInfo, requestCount)
+                    if requestCount == 0:
+                        self.timeoutsNoRequest += 1
+                    break
+                if request.timedOut == "header":
+                    self.timeoutsHeader += 1
+                elif request.timedOut == "body":
+                    self.timeoutsBody += 1
+                if not ok: # Client has closed its end
+                    break
+                if self._heapLow():
+                    logger.warning(const("Request shed, mem free: %d Client: %s"), gc.mem_free(), peerInfo)
+                    self.requestsShed += 1
+                    writer.write(_busyResponse)
+                    await writer.drain()
+                    break
+                requestCount += 1
+                keepAlive = await self.serve_request(request, reader, writer, peerInfo, requestCount)
+        except Exception as e:
+            logger.error(const("Exception processing request: Client: %s Ex: %s err: %s"), peerInfo, str(e), str(getattr(e, "errno", "")))
+        finally:
             try:
-                del request
-                del raw_request
-                # build response message
-                response_builder.build_response()
-                writer.write(response_builder.response)
-                await writer.drain()
-                if response_builder.isFile: # It was a file...
-                    writeLen = response_builder.contentLen
-                    buf = bytearray(1024)
-                    mv = memoryview(buf)
-                    with response_builder.fd as fd:
-                        while writeLen > 0:
-                            readLen = fd.readinto(buf) # We have a handy 1024 byte buffer
-                            writeLen = writeLen - readLen
-                            writer.write(mv[0:readLen])
-                            await writer.drain()
-                        fd.close()
-                            
+                writer.close()
+                await writer.wait_closed()
             except Exception as e:
-                logger.error(const("Exception building/writing response: %s err: %s"), str(e), str(e.errno))
-            finally:
-                await writer.drain()
+                logger.debug(const("Exception closing connection: Client: %s Ex: %s"), peerInfo, str(e))
+            if request is None or request.holdsSlot:
+                self._release()
+
+    # Handles a single request on the connection, returning True if the connection should be
+    # kept open for another one
+    async def serve_request(self, request, reader, writer, peerInfo, requestCount):
+        # Kept in the access log once served - this is only for debugging
+        logger.debug(const("Request: client: %s method: %s URL: %s"), peerInfo, request.method, request.full_url)
+
+        response_builder = ResponseBuilder(self.docroot, self.docIndex, self.responseCache)
+        # Keep the connection if the client wants it, it hasn't had its quota of requests and
+        # nobody else is waiting for its slot - decided now, so the response tells the client
+        keepAlive = request.error == 0 and request.keep_alive() \
+                    and requestCount < self.maxKeepAliveRequests and self.connectionsQueued == 0
+        response_builder.set_keep_alive(keepAlive, self.keepAliveTimeout,
+                                        self.maxKeepAliveRequests - requestCount)
+        response_builder.head = request.method == "HEAD"
+
+        handler, params, route = self.router.match(request.method, request.url)
+        if request.error:
+            # Couldn't make sense of it, or it was too big
+            response_builder.status = request.error
+        elif handler is not None:
+            result = handler(request, response_builder, params)
+            if hasattr(result, "send"): # A coroutine
+                result = await result
+            if result is False: # Handler has had the connection
                 del response_builder
-                await writer.wait_closed()
-                
+                _requests.inc(route, "stream")
+                # Status 0: it's been and gone by now, however long the stream lasted
+                self.accessLog.add(peerInfo[0] if peerInfo else None, request.method, route, 0, 0,
+                                   time.ticks_diff(time.ticks_ms(), request.started))
+                return False
+        elif request.method == "GET" or request.method == "HEAD":
+            # try to serve static file - HEAD only for these, the endpoints may stream
+            # ResponseBuilder checks it all out...
+            route = "static"
+            response_builder.serve_static_file(request.url, "/index.html", request)
+        else:
+            response_builder.status = 404
+        if route is None:
+            route = "none"
+
+        if response_builder.status >= 400:
+            logger.warning(const("Error %d on Request %s %s"), response_builder.status, request.method, request.full_url)
+
+        """
+        try/except/finally to handle running out of Heap Memory error,
+        largely alleviated now by the loop with a fixed length buffer read
+        and deleting local vars
+        """
+        try:
+            # Whatever's left of requestTimeout, but no more than writeTimeout - and a 408 for a
+            # request that ran out of it gets writeTimeout, so the client is told
+            timeout = self.requestTimeout - time.ticks_diff(time.ticks_ms(), request.started) / 1000
+            if request.timedOut:
+                timeout = self.writeTimeout
+            keepAlive = await asyncio.wait_for(response_builder.send(writer), min(timeout, self.writeTimeout))
+        except asyncio.TimeoutError:
+            logger.warning(const("Timed out sending response: Client: %s URL: %s"), peerInfo, request.full_url)
+            self.timeoutsWrite += 1
+            keepAlive = False
         except Exception as e:
-            logger.error(const("Exception processing request: Client: %s Ex: %s err: %s"), peerInfo, str(e), str(e.errno))
+            logger.error(const("Exception building/writing response: %s err: %s"), str(e), str(getattr(e, "errno", "")))
+            keepAlive = False # No idea what state the connection is in
+        finally:
+            _requests.inc(route, response_builder.status)
+            nbytes = 0 if response_builder.head else response_builder.contentLen
+            elapsed = time.ticks_diff(time.ticks_ms(), request.started)
+            _responseBytes.inc(route, n=nbytes)
+            _latency.observe(elapsed, route)
+            self.accessLog.add(peerInfo[0] if peerInfo else None, request.method, route,
+                               response_builder.status, nbytes, elapsed)
+            metrics.sampleHeap()
+            del response_builder
+        return keepAlive
+
+    # Built-in endpoints, called as handler(request, response_builder, params)
+    def _data(self, request, response, params):
+        accept = request.get_header_value('Accept')
+        if accept and accept.find("application/cbor") >= 0:
+            return self._dataCBOR(request, response, params)
+        since = self._since(request)
+        if since is False:
+            response.status = 400
+            return
+        # JS Fetch request for data
+        response.set_body_from_dict(self.getData(since))
+        logger.debug(const("Response Body: %s"), response.body)
+
+    def _dataCBOR(self, request, response, params):
+        since = self._since(request)
+        if since is False:
+            response.status = 400
+            return
+        response.set_body(self.getDataCBOR(since))
+        response.set_content_type("application/cbor")
+
+    def _since(self, request):
+        # The since=<seq> query parameter: None if there isn't one, False if it's not a number
+        since = request.query_params.get("since")
+        if since is None:
+            return None
+        try:
+            return int(since)
+        except (ValueError, TypeError):
+            return False
+
+    def _history(self, request, response, params):
+        # ?channel=<value name>[&res=<bucket secs>][&n=<count>]: the Sensor's recent samples as
+        # {"channel", "t": [...], "v": [...]}, or with res its rollups as {"channel", "resolution",
+        # "t", "count", "mean", "min", "max"} - columns rather than objects, it's a lot smaller
+        # With from= and/or to= (secs) it's the samples logged to flash instead - see _logHistory
+        channel = request.query_params.get("channel")
+        if "from" in request.query_params or "to" in request.query_params:
+            return self._logHistory(request, response, channel)
+        try:
+            res = request.query_params.get("res")
+            res = None if res is None else int(res)
+            n = request.query_params.get("n")
+            n = None if n is None else int(n)
+        except (ValueError, TypeError):
+            response.status = 400
+            return
+        if not channel:
+            response.status = 400
+            return
+        if res is None:
+            t = []
+            v = []
+            for d in self.dataSources:
+                if hasattr(d, "getHistory"):
+                    for times, values in d.getHistory(channel, n):
+                        for i in range(len(times)):
+                            x = values[i]
+                            if x != x or x == 0xffff and isinstance(x, int): # Not in that sample
+                                continue
+                            t.append(times[i])
+                            v.append(round(x, 2))
+                    if t:
+                        break
+            response.set_body_from_dict({"channel": channel, "t": t, "v": v})
+            return
+        rollup = []
+        for d in self.dataSources:
+            if hasattr(d, "getRollup"):
+                rollup = d.getRollup(channel, res, n)
+                if rollup:
+                    break
+        response.set_body_from_dict({"channel": channel, "resolution": res,
+                                     "t": [b[0] for b in rollup], "count": [b[1] for b in rollup],
+                                     "mean": [round(b[2], 2) for b in rollup],
+                                     "min": [round(b[3], 2) for b in rollup],
+                                     "max": [round(b[4], 2) for b in rollup]})
+
+    async def _logHistory(self, request, response, channel):
+        # CSV "time,channel,value" lines from the first Sensor's SampleLog, streamed as they're
+        # read - could be weeks of it, so no Content-Length and the connection closes at the end
+        sampleLog = None
+        for d in self.dataSources:
+            sampleLog = getattr(d, "sampleLog", None)
+            if sampleLog is not None:
+                break
+        try:
+            # Empty (from=&to=) is the same as not there: that end is open
+            fromTime = request.query_params.get("from")
+            fromTime = int(fromTime) if fromTime else 0
+            toTime = request.query_params.get("to")
+            toTime = int(toTime) if toTime else 0xffffffff
+        except (ValueError, TypeError):
+            response.status = 400
+            return
+        if sampleLog is None:
+            response.status = 404
+            return
+        writer = request.writer
+        writer.write(b"HTTP/1.1 200 OK\r\nServer: " + ResponseBuilder.server.encode() +
+                     b"\r\nContent-Type: text/csv\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n"
+                     b"time,channel,value\r\n")
+        out = []
+        try:
+            for t, name, value in sampleLog.query(fromTime, toTime, channel or None):
+                out.append("%d,%s,%g\r\n" % (t, name, value))
+                if len(out) >= 32:
+                    writer.write("".join(out).encode())
+                    out = []
+                    await asyncio.wait_for(writer.drain(), self.writeTimeout)
+            if out:
+                writer.write("".join(out).encode())
+            await asyncio.wait_for(writer.drain(), self.writeTimeout)
+        except asyncio.TimeoutError:
+            logger.warning(const("History stream stalled, closing: Client: %s"), request.peerInfo)
+            self.timeoutsWrite += 1
+        except Exception as e:
+            logger.debug(const("History stream ended: Client: %s Ex: %s"), request.peerInfo, str(e))
+        return False
+
+    def _stats(self, request, response, params):
+        response.set_body_from_dict(self.getStats())
+
+    def _config(self, request, response, params):
+        response.set_body_from_dict(self.getConfig())
+
+    def _metrics(self, request, response, params):
+        response.set_body(metrics.render())
+        response.set_content_type("text/plain; version=0.0.4")
+
+    def _accessLog(self, request, response, params):
+        # Plain text, one request a line, oldest first: ?n= for just the last n
+        try:
+            n = int(request.query_params.get("n", self.accessLog.size))
+        except (ValueError, TypeError):
+            n = self.accessLog.size
+        response.set_body("".join(self.accessLog.lines(n)))
+        response.set_content_type("text/plain")
+
+    def _action(self, request, response, params):
+        # Form POST - time to do something...
+        if "action" in request.post_data:
+            action = request.post_data["action"]
+            returnPage = self.actionHandler(action, request.post_data)
+            if returnPage == "": # Whoops, unknown action!
+                logger.error("Action '%s' not implemented or unknown! Fix HTML Form %s", action, request.url)
+                response.status = 422
+            else:
+                response.serve_static_file(returnPage, returnPage, request)
+        else:
+            # Whoops - no action param in returned form values - fix HTML!
+            logger.error("No Action input element in Form - Fix HTML Form %s", request.url)
+            response.status = 422
+
+    def _cmd(self, request, response, params):
+        # Same actions as /action, for scripts: the action is in the URL and its values in the body
+        # (JSON or form); replies with JSON
+        action = params["action"]
+        returnPage = self.actionHandler(action, request.post_data)
+        logger.info(const("Command: %s page: %s"), action, returnPage)
+        response.set_body_from_dict({"action": action, "ok": returnPage != "", "page": returnPage})
+        if returnPage == "":
+            response.status = 422
+
+    async def _events(self, request, response, params):
+        # Takes over the connection until the client goes away
+        self._detach(request)
+        return await self.serve_events(request.writer, request.peerInfo)
+
+    async def _websocket(self, request, response, params):
+        # WebSocket upgrade - also takes over the connection
+        self._detach(request)
+        return await self.serve_websocket(request, request.reader, request.writer, request.peerInfo)
+
+    # Data sources are functions returning a dict of values, or Sensors, which number their samples
+    # so that with since=<seq> just the values changed in later samples can be returned (functions
+    # can't say what's changed, so theirs are always all there)
+    def _values(self, source, since):
+        if not hasattr(source, "getValuesSince"):
+            return source()
+        if since is None:
+            return source.getValues()
+        return source.getValuesSince(since)
+
+    def _latestSample(self):
+        # (sequence number, time) of the latest sample from any of the Sensors
+        seq = 0
+        sampleTime = 0
+        for d in self.dataSources:
+            if getattr(d, "sampleSeq", 0) > seq:
+                seq = d.sampleSeq
+                sampleTime = d.sampleTime
+        return seq, sampleTime
+
+    # Waits for the next sample - the /events and /ws pushers' pause. dataEvent only wakes those
+    # already waiting on it, so a sample numbered after seq (the latest when the caller last read
+    # the data) that came while the caller was busy sending means there's no waiting at all.
+    # At most eventHeartbeat secs, or 1 sec if there's no dataEvent
+    async def _waitForData(self, seq):
+        if self.dataEvent is None:
+            await asyncio.sleep(1)
+            return
+        if self._latestSample()[0] != seq:
+            return
+        try:
+            await asyncio.wait_for(self.dataEvent.wait(), self.eventHeartbeat)
+        except asyncio.TimeoutError:
+            pass
+
+    # Current values from all the data sources as a CBOR map {"status": 0, <name>: <value>, ...},
+    # encoded straight from each source's dict; with since, "seq" and "time" of the latest sample
+    # are added and only values changed after since are included
+    def getDataCBOR(self, since=None):
+        seq, sampleTime = self._latestSample()
+        if since is not None and since > seq: # We've restarted since the client last asked
+            since = 0
+        sources = [self._values(d, since) for d in self.dataSources]
+        count = 1 if since is None else 3
+        for values in sources:
+            count += len(values)
+        buf = bytearray()
+        cbor.encodeMapHeader(buf, count)
+        cbor.encodeInto(buf, "status")
+        cbor.encodeInto(buf, 0)
+        if since is not None:
+            cbor.encodeInto(buf, "seq")
+            cbor.encodeInto(buf, seq)
+            cbor.encodeInto(buf, "time")
+            cbor.encodeInto(buf, sampleTime)
+        for values in sources:
+            for k, v in values.items():
+                cbor.encodeInto(buf, k)
+                cbor.encodeInto(buf, v)
+        return buf
+
+    # Current values from all the data sources, as a list of single-item dicts; with since, as
+    # for getDataCBOR()
+    def getData(self, since=None):
+        response_obj = [{'status': 0}]
+        if since is not None:
+            seq, sampleTime = self._latestSample()
+            if since > seq:
+                since = 0
+            response_obj.append({'seq': seq})
+            response_obj.append({'time': sampleTime})
+        for d in self.dataSources:
+            values = self._values(d, since)
+            for k, v in values.items():
+                response_obj.append({k:v})
+        return response_obj
+
+    # Server-Sent Events stream: sends the data as JSON whenever it changes
+    # The client gets the same JSON as /data, one "data:" line per update
+    async def serve_events(self, writer, peerInfo):
+        if self.eventClients >= self.maxEventClients:
+            logger.warning(const("Event stream refused, %d clients already: Client: %s"), self.eventClients, peerInfo)
+            writer.write(_busyResponse)
+            await writer.drain()
+            return False
+        self.eventClients += 1
+        logger.info(const("Event stream started: Client: %s clients: %d"), peerInfo, self.eventClients)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nServer: " + ResponseBuilder.server.encode() +
+                         b"\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n"
+                         b"retry: 5000\n\n")
+            await writer.drain()
+            lastData = None
+            lastSent = time.time()
+            while True:
+                seq = self._latestSample()[0]
+                data = json.dumps(self.getData())
+                if data != lastData:
+                    writer.write(b"data: " + data.encode("utf-8") + b"\n\n")
+                    lastData = data
+                    lastSent = time.time()
+                elif time.time() - lastSent >= self.eventHeartbeat:
+                    writer.write(b":\n\n") # Comment - ignored by EventSource
+                    lastSent = time.time()
+                # Raises once the client has gone, or times out if it's stopped taking data
+                await asyncio.wait_for(writer.drain(), self.writeTimeout)
+                await self._waitForData(seq)
+        except asyncio.TimeoutError:
+            logger.warning(const("Event stream stalled, closing: Client: %s"), peerInfo)
+            self.timeoutsWrite += 1
+        except Exception as e:
+            logger.debug(const("Event stream ended: Client: %s Ex: %s"), peerInfo, str(e))
+        finally:
+            self.eventClients -= 1
+        return False
+
+    # WebSocket connection: JSON text messages
+    #   server -> client {"type": "data", "data": <same list as /data>} when it changes
+    #                    {"type": "result", "action": <action>, "ok": true/false, "page": <page>}
+    #                    {"type": "error", "error": <why>}
+    #   client -> server {"type": "action", "action": <action>, <param>: <value>, ...} with the
+    #                    same values a form POST to /action would have
+    #                    {"type": "data"} to get the current data straight away
+    # The server pings every eventHeartbeat secs; no frames at all for twice that and it hangs up
+    async def serve_websocket(self, request, reader, writer, peerInfo):
+        if self.webSocketClients >= self.maxWebSocketClients:
+            logger.warning(const("WebSocket refused, %d clients already: Client: %s"), self.webSocketClients, peerInfo)
+            writer.write(_busyResponse)
+            await writer.drain()
+            return False
+        ws = WebSocket(reader, writer)
+        if not await ws.accept(request):
+            logger.warning(const("Bad WebSocket upgrade request: Client: %s"), peerInfo)
+            return False
+        self.webSocketClients += 1
+        logger.info(const("WebSocket opened: Client: %s clients: %d"), peerInfo, self.webSocketClients)
+        pushTask = asyncio.create_task(self._ws_push(ws))
+        try:
+            while ws.open:
+                message = await ws.recv(2 * self.eventHeartbeat)
+                if message is None:
+                    break
+                await self._ws_message(ws, message)
+        except Exception as e:
+            logger.debug(const("WebSocket ended: Client: %s Ex: %s"), peerInfo, str(e))
+        finally:
+            pushTask.cancel()
+            await ws.close()
+            self.webSocketClients -= 1
+        return False
+
+    async def _ws_push(self, ws):
+        lastData = None
+        lastSent = time.time()
+        try:
+            while ws.open:
+                seq = self._latestSample()[0]
+                data = json.dumps(self.getData())
+                if data != lastData:
+                    await ws.send('{"type": "data", "data": ' + data + '}')
+                    lastData = data
+                    lastSent = time.time()
+                elif time.time() - lastSent >= self.eventHeartbeat:
+                    await ws.ping()
+                    lastSent = time.time()
+                await self._waitForData(seq)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(const("WebSocket push ended: %s"), str(e))
+
+    async def _ws_message(self, ws, message):
+        try:
+            msg = json.loads(message)
+            msgType = msg.get("type")
+        except (ValueError, AttributeError):
+            await ws.send('{"type": "error", "error": "not a JSON object"}')
+            return
+        if msgType == "action":
+            action = msg.get("action")
+            returnPage = self.actionHandler(action, msg)
+            logger.info(const("WebSocket action: %s page: %s"), action, returnPage)
+            await ws.send(json.dumps({"type": "result", "action": action, "ok": returnPage != "", "page": returnPage}))
+        elif msgType == "data":
+            await ws.send('{"type": "data", "data": ' + json.dumps(self.getData()) + '}')
+        else:
+            await ws.send(json.dumps({"type": "error", "error": "unknown type %s" % msgType}))
 
 def getValues():
     return {"temp0":random.uniform(40,65), "temp1":random.uniform(40,65)}
@@ -0,0 +1,177 @@
+"""
+    WebSocket
+    Minimal RFC 6455 WebSocket server-side connection, run over the same asyncio
+    streams as the WebServer once a request has asked to upgrade.
+
+    accept(request)
+        Checks the upgrade request and sends the 101 Switching Protocols response;
+        returns False (having sent an error response) if it isn't a valid upgrade
+
+    recv(idleTimeout)
+        Returns the next complete text (str) or binary (bytes) message, None once the
+        connection is closed. Pings are answered, fragmented messages reassembled and
+        client masking removed along the way. With idleTimeout (secs), raises
+        asyncio.TimeoutError once that long has passed with no frame from the client -
+        pongs and pings count, so a client that only answers pings stays connected
+
+    send(message)
+        Sends a str as a text message, bytes as binary; each frame goes out in a single
+        write() so frames from different tasks can't get mixed up
+
+    ping(), close(code)
+
+"""
+import asyncio, time
+import struct
+import hashlib
+import binascii
+import logging
+from micropython import const
+
+logger = logging.getLogger(__name__)
+from ESPLogRecord import ESPLogRecord
+logger.record = ESPLogRecord()
+
+_GUID = const(b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11")
+
+OP_CONT = const(0x0)
+OP_TEXT = const(0x1)
+OP_BINARY = const(0x2)
+OP_CLOSE = const(0x8)
+OP_PING = const(0x9)
+OP_PONG = const(0xA)
+
+CLOSE_NORMAL = const(1000)
+CLOSE_PROTOCOL_ERROR = const(1002)
+CLOSE_TOO_BIG = const(1009)
+
+def accept_key(key):
+    """ Sec-WebSocket-Accept value for the client's Sec-WebSocket-Key """
+    digest = hashlib.sha1(key.encode() + _GUID).digest()
+    return binascii.b2a_base64(digest).strip().decode()
+
+class WebSocket:
+
+    def __init__(self, reader, writer, maxMessageSize=4096):
+        self.reader = reader
+        self.writer = writer
+        self.maxMessageSize = maxMessageSize
+        self.open = False
+        self.lastFrame = time.ticks_ms()	# When the last frame of any kind arrived
+
+    async def accept(self, request):
+        upgrade = request.get_header_value('Upgrade')
+        key = request.get_header_value('Sec-WebSocket-Key')
+        if request.method != 'GET' or not upgrade or upgrade.lower() != 'websocket' or not key:
+            self.writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await self.writer.drain()
+            return False
+        if request.get_header_value('Sec-WebSocket-Version') != '13':
+            self.writer.write(b"HTTP/1.1 426 Upgrade Required\r\nSec-WebSocket-Version: 13\r\n"
+                              b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+            await self.writer.drain()
+            return False
+        self.writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          b"Sec-WebSocket-Accept: " + accept_key(key).encode() + b"\r\n\r\n")
+        await self.writer.drain()
+        self.open = True
+        return True
+
+    async def _read_frame(self):
+        # Returns (fin, opcode, payload)
+        hdr = await self.reader.readexactly(2)
+        fin = hdr[0] & 0x80
+        opcode = hdr[0] & 0x0F
+        length = hdr[1] & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+        if not hdr[1] & 0x80:
+            # Clients must mask everything they send
+            await self.close(CLOSE_PROTOCOL_ERROR)
+            return (True, OP_CLOSE, b"")
+        if length > self.maxMessageSize:
+            await self.close(CLOSE_TOO_BIG)
+            return (True, OP_CLOSE, b"")
+        mask = await self.reader.readexactly(4)
+        payload = bytearray(await self.reader.readexactly(length)) if length else bytearray()
+        for i in range(length):
+            payload[i] ^= mask[i & 3]
+        self.lastFrame = time.ticks_ms()
+        return (fin, opcode, payload)
+
+    async def recv(self, idleTimeout=None):
+        message = None
+        messageType = OP_TEXT
+        while self.open:
+            if idleTimeout is None:
+                fin, opcode, payload = await self._read_frame()
+            else:
+                # Timed from the last frame, so every frame - control frames too - restarts it
+                idle = time.ticks_diff(time.ticks_ms(), self.lastFrame)
+                fin, opcode, payload = await asyncio.wait_for(self._read_frame(), max(0, idleTimeout * 1000 - idle) / 1000)
+            if opcode == OP_PING:
+                await self._send_frame(OP_PONG, payload)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CLOSE:
+                if self.open: # Echo the close back
+                    await self.close(CLOSE_NORMAL)
+                return None
+            if opcode == OP_CONT:
+                if message is None:
+                    await self.close(CLOSE_PROTOCOL_ERROR)
+                    return None
+                message += payload
+                if len(message) > self.maxMessageSize:
+                    await self.close(CLOSE_TOO_BIG)
+                    return None
+            else:
+                message = payload
+                messageType = opcode
+            if fin:
+                if messageType == OP_TEXT:
+                    return bytes(message).decode("utf-8")
+                return bytes(message)
+        return None
+
+    async def _send_frame(self, opcode, payload=b""):
+        length = len(payload)
+        if length < 126:
+            frame = bytearray(2 + length)
+            frame[1] = length
+            offset = 2
+        elif length < 65536:
+            frame = bytearray(4 + length)
+            frame[1] = 126
+            struct.pack_into("!H", frame, 2, length)
+            offset = 4
+        else:
+            frame = bytearray(10 + length)
+            frame[1] = 127
+            struct.pack_into("!Q", frame, 2, length)
+            offset = 10
+        frame[0] = 0x80 | opcode
+        frame[offset:] = payload
+        self.writer.write(frame)
+        await self.writer.drain()
+
+    async def send(self, message):
+        if isinstance(message, str):
+            await self._send_frame(OP_TEXT, message.encode("utf-8"))
+        else:
+            await self._send_frame(OP_BINARY, message)
+
+    async def ping(self):
+        await self._send_frame(OP_PING)
+
+    async def close(self, code=CLOSE_NORMAL):
+        if not self.open:
+            return
+        self.open = False
+        try:
+            await self._send_frame(OP_CLOSE, struct.pack("!H", code))
+        except Exception as e:
+            logger.debug(const("Exception sending close: %s"), str(e))
@@ -9,7 +9,6 @@ from micropython import const
 
 # Note that you can't use the module name "network" for your own stuff - Python has already used it! 
 from networking.WiFiConnection import WiFiConnection
-from web.url_parse import url_parse
 from web.MOTD import MOTD
 
 logger = logging.getLogger(__name__)
@@ -33,9 +32,9 @@ def actionHandler(action, params):
         if action == "network":
             # Network config
             # hostname, ssid, password
-            hostname = url_parse(params['hostname'])
-            ssid = url_parse(params['ssid'])
-            password = url_parse(params['password'])
+            hostname = params['hostname']
+            ssid = params['ssid']
+            password = params['password']
             # Do we want to modify
             # a) hostname
             if (hostname != ""):
@@ -48,8 +47,7 @@ def actionHandler(action, params):
         elif action == "message":
             # MOTD
             logger.debug("actionHandler: MOTD type:%s, value:%s", type(params['MOTD']), params['MOTD'])
-            logger.debug("actionHandler: MOTD parsed:%s", url_parse(params['MOTD']))
-            MOTD.setMessage(url_parse(params['MOTD']))
+            MOTD.setMessage(params['MOTD'])
             logger.info(const("actionHandler: MOTD set: %s "), MOTD.getMessage() )
     
         return("thanks.html")
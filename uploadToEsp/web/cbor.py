@@ -0,0 +1,75 @@
+"""
+    cbor
+    Minimal CBOR (RFC 8949) encoder for machine clients of the WebServer - any CBOR
+    library on the collecting end can read it (e.g. Python's cbor2.loads).
+
+    dumps(obj)
+        Returns bytes; handles dict, list/tuple, str, bytes, int, float, bool and None
+    encodeInto(buf, obj), encodeMapHeader(buf, n)
+        Append to a bytearray, so a map can be written straight from several dicts
+        without gathering them into one first
+
+    Floats go out as 32 bit (sensor readings don't have more precision than that), so
+    a reading takes 5 bytes rather than the 4-10 characters of its JSON.
+"""
+import struct
+
+def _head(buf, major, n):
+    # Major type in the top 3 bits, then the length/value in the smallest form it fits
+    major <<= 5
+    if n < 24:
+        buf.append(major | n)
+    elif n < 0x100:
+        buf.append(major | 24)
+        buf.append(n)
+    elif n < 0x10000:
+        buf.append(major | 25)
+        buf.extend(struct.pack(">H", n))
+    elif n < 0x100000000:
+        buf.append(major | 26)
+        buf.extend(struct.pack(">I", n))
+    else:
+        buf.append(major | 27)
+        buf.extend(struct.pack(">Q", n))
+
+def encodeMapHeader(buf, n):
+    _head(buf, 5, n)
+
+def encodeInto(buf, obj):
+    if obj is None:
+        buf.append(0xf6)
+    elif obj is True:
+        buf.append(0xf5)
+    elif obj is False:
+        buf.append(0xf4)
+    elif isinstance(obj, int):
+        if obj >= 0:
+            _head(buf, 0, obj)
+        else:
+            _head(buf, 1, -1 - obj)
+    elif isinstance(obj, float):
+        buf.append(0xfa)
+        buf.extend(struct.pack(">f", obj))
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        _head(buf, 3, len(data))
+        buf.extend(data)
+    elif isinstance(obj, (bytes, bytearray)):
+        _head(buf, 2, len(obj))
+        buf.extend(obj)
+    elif isinstance(obj, (list, tuple)):
+        _head(buf, 4, len(obj))
+        for item in obj:
+            encodeInto(buf, item)
+    elif isinstance(obj, dict):
+        _head(buf, 5, len(obj))
+        for k, v in obj.items():
+            encodeInto(buf, k)
+            encodeInto(buf, v)
+    else:
+        raise TypeError("can't CBOR encode %s" % type(obj))
+
+def dumps(obj):
+    buf = bytearray()
+    encodeInto(buf, obj)
+    return bytes(buf)
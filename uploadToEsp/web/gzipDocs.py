@@ -0,0 +1,89 @@
+"""
+    gzipDocs
+    Creates a gzipped "<file>.gz" alongside each file in the web docroot, which
+    ResponseBuilder.serve_static_file() then serves to clients that accept gzip.
+
+    Runs either
+    - on your computer before uploading, from the uploadToEsp folder:
+        python web/gzipDocs.py webdocs
+    - on the ESP32 (needs MicroPython 1.21+ for the deflate module), from the REPL:
+        from web.gzipDocs import gzipDocs
+        gzipDocs("/webdocs")
+
+    A .gz is only kept if it is actually smaller, and is only rebuilt if the original
+    is newer. Re-run it whenever you change anything in the docroot! If the WebServer
+    is already running, call its invalidateDocs() afterwards so it sees the new files.
+"""
+import os
+import logging
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+logger = logging.getLogger(__name__)
+try:
+    from ESPLogRecord import ESPLogRecord
+    logger.record = ESPLogRecord()
+except ImportError:
+    pass
+
+try:
+    import gzip				# CPython
+    deflate = None
+except ImportError:
+    gzip = None
+    import deflate			# MicroPython
+
+# Already compressed, or not worth the bother
+skipTypes = (const("gz"), const("png"), const("jpg"), const("jpeg"), const("gif"), const("ico"))
+
+def _compress(src, dst):
+    buf = bytearray(512)
+    with open(src, 'rb') as fi:
+        with open(dst, 'wb') as raw:
+            if gzip:
+                fo = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=9, mtime=0)
+            else:
+                # Small window so neither end needs much RAM
+                fo = deflate.DeflateIO(raw, deflate.GZIP, 10)
+            while True:
+                n = fi.readinto(buf)
+                if not n:
+                    break
+                fo.write(buf[:n])
+            fo.close()
+
+def gzipDocs(docroot="/webdocs", minSize=256):
+    """ Compresses every file in docroot (and below) bigger than minSize bytes """
+    saved = 0
+    for name in os.listdir(docroot):
+        src = docroot + "/" + name
+        st = os.stat(src)
+        if st[0] & 0x4000: # Directory
+            saved += gzipDocs(src, minSize)
+            continue
+        if name.rsplit(".", 1)[-1].lower() in skipTypes or st[6] < minSize:
+            continue
+        dst = src + ".gz"
+        try:
+            if os.stat(dst)[8] >= st[8]:
+                continue # Up to date
+        except OSError:
+            pass
+        _compress(src, dst)
+        gzSize = os.stat(dst)[6]
+        if gzSize >= st[6]:
+            os.remove(dst)
+            logger.info(const("%s: no smaller compressed, skipped"), src)
+        else:
+            saved += st[6] - gzSize
+            logger.info(const("%s: %d -> %d bytes"), src, st[6], gzSize)
+    return saved
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    docroot = sys.argv[1] if len(sys.argv) > 1 else "/webdocs"
+    print("Saved %d bytes" % gzipDocs(docroot.rstrip("/")))
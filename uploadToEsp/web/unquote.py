@@ -1,60 +0,0 @@
-
-_hextobyte_cache = None
-
-def unquote(string):
-    """unquote('abc%20def') -> b'abc def'."""
-    global _hextobyte_cache
-
-    # Note: strings are encoded as UTF-8. This is only an issue if it contains
-    # unescaped non-ASCII characters, which URIs should not.
-    if not string:
-        return b''
-
-    if isinstance(string, str):
-        string = string.encode('utf-8')
-
-    bits = string.split(b'%')
-    if len(bits) == 1:
-        return string
-
-    res = [bits[0]]
-    append = res.append
-
-    # Build cache for hex to char mapping on-the-fly only for codes
-    # that are actually used
-    if _hextobyte_cache is None:
-        _hextobyte_cache = {}
-
-    for item in bits[1:]:
-        try:
-            code = item[:2]
-            char = _hextobyte_cache.get(code)
-            if char is None:
-                char = _hextobyte_cache[code] = bytes([int(code, 16)])
-            append(char)
-            append(item[2:])
-        except KeyError:
-            append(b'%')
-            append(item)
-    # zap '+'
-    return b''.join(res).decode("utf-8").replace('+',' ')
-
-def url_parse(url):
-    l = len(url)
-    data = bytearray()
-    i = 0
-    while i < l:
-        if url[i] != '%':
-            d = ord(url[i])
-            i += 1
-        
-        else:
-            d = int(url[i+1:i+3], 16)
-            i += 3
-        
-        data.append(d)
-    
-    return data.decode('utf8')
-
-s = unquote('This+is+an+exciting+new+MOTD%21')
-print(s, type(s))
\ No newline at end of file
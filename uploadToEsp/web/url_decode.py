@@ -0,0 +1,84 @@
+"""
+    url_decode
+    Percent-decoding for query strings and form (application/x-www-form-urlencoded)
+    bodies - the one decoder used by RequestParser for every query and form value.
+
+    url_decode(src, plus=True)
+        src is a str, bytes, bytearray or memoryview; returns a str. "%XX" escapes are
+        turned back into bytes and the result decoded as UTF-8, so multi-byte characters
+        survive; with plus=True (forms, query strings) "+" means a space. A "%" not
+        followed by two hex digits is left as it is. If the decoded bytes aren't valid
+        UTF-8 a str src is returned undecoded (bytes raise UnicodeError)
+
+    url_decode_bytes(src, plus=True)
+        The same, but returns the decoded bytes
+
+    Escapes are decoded with a 256 entry hex table. On MicroPython builds with the viper
+    emitter (e.g. ESP32) url_decode_viper does it byte by byte in machine code, otherwise
+    plain Python splits on "%" and copies the runs between escapes a slice at a time.
+"""
+
+# Value of each hex digit, 0xFF for anything else
+_HEX = bytearray(b"\xff" * 256)
+for _i in range(10):
+    _HEX[48 + _i] = _i				# 0-9
+for _i in range(6):
+    _HEX[65 + _i] = 10 + _i			# A-F
+    _HEX[97 + _i] = 10 + _i			# a-f
+del _i
+
+_SCRATCH_SIZE = 256
+_scratch = bytearray(_SCRATCH_SIZE)	# Reused for values that fit, which is nearly all of them
+
+def _decode_py(src, n, dst, hexTable, plus):
+    # Plain Python is slow byte by byte, so copy the runs between escapes a slice at a time
+    src = bytes(src)
+    if plus:
+        src = src.replace(b"+", b" ") # Before decoding, so "%2B" still gives "+"
+    runs = src.split(b"%")
+    run = runs[0]
+    j = len(run)
+    dst[0:j] = run
+    for k in range(1, len(runs)):
+        run = runs[k]
+        if len(run) >= 2 and hexTable[run[0]] < 16 and hexTable[run[1]] < 16:
+            dst[j] = (hexTable[run[0]] << 4) | hexTable[run[1]]
+            start = 2
+        else:
+            dst[j] = 37 # Not an escape - keep the '%'
+            start = 0
+        end = j + 1 + len(run) - start
+        dst[j + 1:end] = run[start:]
+        j = end
+    return j
+
+try:
+    from web.url_decode_viper import decode as _decode
+except (ImportError, SyntaxError, AttributeError, NameError):
+    # Not MicroPython, or no viper emitter in this build
+    _decode = _decode_py
+
+def _decode_into(src, plus):
+    # Returns a memoryview of the decoded bytes - only valid until the next call
+    n = len(src)
+    dst = _scratch if n <= _SCRATCH_SIZE else bytearray(n) # Decoding never makes it longer
+    return memoryview(dst)[:_decode(src, n, dst, _HEX, plus)]
+
+def url_decode_bytes(src, plus=True):
+    if isinstance(src, str):
+        src = src.encode("utf-8")
+    return bytes(_decode_into(src, plus))
+
+def url_decode(src, plus=True):
+    if isinstance(src, str):
+        if src.find("%") < 0 and (not plus or src.find("+") < 0):
+            return src # Nothing to do
+        raw = src.encode("utf-8")
+    else:
+        raw = src
+    try:
+        return str(_decode_into(raw, plus), "utf-8")
+    except UnicodeError:
+        if isinstance(src, str):
+            return src
+        raise
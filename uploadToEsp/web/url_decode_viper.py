@@ -0,0 +1,28 @@
+"""
+    url_decode_viper
+    Native code version of the url_decode loop - kept in its own module because a
+    MicroPython build without the viper emitter can't even compile it; url_decode
+    falls back to plain Python if importing this fails.
+"""
+import micropython
+
+@micropython.viper
+def decode(src: ptr8, n: int, dst: ptr8, hexTable: ptr8, plus: int) -> int:
+    i = 0
+    j = 0
+    while i < n:
+        c = src[i]
+        if c == 37 and i + 2 < n: # '%'
+            hi = hexTable[src[i + 1]]
+            lo = hexTable[src[i + 2]]
+            if hi < 16 and lo < 16:
+                dst[j] = (hi << 4) | lo
+                i += 3
+                j += 1
+                continue
+        elif c == 43 and plus: # '+'
+            c = 32
+        dst[j] = c
+        i += 1
+        j += 1
+    return j